@@ -5,12 +5,19 @@ File: utilities/llm_utils.py
 Description: Implements llm calls
 """
 
-from fastapi import FastAPI, Request, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, Request, HTTPException, Depends, Query, status, UploadFile, File, Form
 from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import subprocess
 import uvicorn
 from utilities.utils import *
+from utilities.compaction_utils import memory_compactor
+from utilities.summary_utils import rolling_summarizer
+from utilities.archive_utils import conversation_archiver
+from utilities.auth_utils import authorize, require_session, require_session_always, require_session_secret, close_hash_executor
+from utilities.export_utils import export_user_data, decode_export_cursor
+from utilities.document_utils import receive_upload, remove_upload, delete_document, DocumentError, UploadTooLarge
+from datetime import datetime
 import asyncio
 import time
 import os
@@ -21,6 +28,33 @@ from termcolor import colored
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def startup_event():
+    require_session_secret()
+    await init_db()
+    # Start background workers; this also resumes jobs left by a recycled worker
+    await job_queue.start()
+    await conversation_buffer.start()
+    await memory_compactor.start()
+    await rolling_summarizer.start()
+    await conversation_archiver.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await memory_compactor.stop()
+    await rolling_summarizer.stop()
+    await conversation_archiver.stop()
+    await job_queue.stop()
+    # Commit any buffered conversation turns before the pool closes
+    await conversation_buffer.stop()
+    # Close pooled LLM connections held by this worker
+    await close_llm_clients()
+    close_hash_executor()
+    # Write out stamps other workers have not seen yet
+    context_cache.close()
+    close_tts_client()
+    await close_db()
+
 class InputData(BaseModel):
     utterance: str
     user_name: str
@@ -42,64 +76,95 @@ class Login(BaseModel):
     password: str
 
 @app.post("/sign_up")
-async def new_user_sign_up(user: UserCreate, db: Session = Depends(get_db)):
+async def new_user_sign_up(user: UserCreate, db: AsyncSession = Depends(get_db)):
     user_id = generate_new_user_id()
     try:
-        return create_user(user_id=user_id, name=user.name, email=user.email, password=user.password, db=db)
+        return await create_user(user_id=user_id, name=user.name, email=user.email, password=user.password, db=db)
     except Exception as e:
         return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "Internal Server Error"})
 
 @app.post("/login")
-async def login(login : Login, db: Session = Depends(get_db)):
+async def login(login : Login, db: AsyncSession = Depends(get_db)):
     # try:
-        return user_login(email=login.email, password=login.password, db=db)
+        return await user_login(email=login.email, password=login.password, db=db)
     # except Exception as e:
         # return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "Internal Server Error"})
 
 # Read user by user_id
-@app.get("/users/{user_id}")
-async def read_user(user_id: str, db: Session = Depends(get_db)):
-    db_user = get_user_by_id(user_id=user_id, db=db)
+@app.get("/users/{user_id}", dependencies=[Depends(require_session)])
+async def read_user(user_id: str, db: AsyncSession = Depends(get_db)):
+    db_user = await get_user_by_id(user_id=user_id, db=db)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 # Update user details
-@app.put("/users/{user_id}")
-async def update_user_route(user_id: str, user: UserUpdate, db: Session = Depends(get_db)):
-    db_user = update_user(user_id=user_id, name=user.name, password=user.password, db=db)
+@app.put("/users/{user_id}", dependencies=[Depends(require_session)])
+async def update_user_route(user_id: str, user: UserUpdate, db: AsyncSession = Depends(get_db)):
+    db_user = await update_user(user_id=user_id, name=user.name, password=user.password, db=db)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return {"message": "User updated", "user": db_user}
 
 # Delete a user
-@app.delete("/users/{user_id}")
-async def delete_user_route(user_id: str, db: Session = Depends(get_db)):
-    db_user = delete_user(user_id=user_id, db=db)
+@app.delete("/users/{user_id}", dependencies=[Depends(require_session)])
+async def delete_user_route(user_id: str, db: AsyncSession = Depends(get_db)):
+    db_user = await delete_user(user_id=user_id, db=db)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return {"message": "User deleted", "user": db_user}
 
+# LLM cache hit/miss counters for this worker
+@app.get("/cache_stats")
+async def cache_stats():
+    return llm_cache.stats()
+
+@app.get("/tts_cache_stats")
+async def tts_cache_stats():
+    return speech_synthesizer.stats()
+
+@app.get("/context_cache_stats")
+async def context_cache_stats():
+    return context_cache.stats()
+
+# Page through a user's conversation history, newest first
+@app.get("/conversation/{user_id}", dependencies=[Depends(require_session)])
+async def conversation_history_route(user_id: str, cursor: str = None, limit: int = Query(None, ge=1), db: AsyncSession = Depends(get_db)):
+    try:
+        return await read_conversation_page(user_id=user_id, db=db, cursor=cursor, limit=limit)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"message": "Invalid cursor"})
+
+# Stream all of a user's data as NDJSON, optionally for a time range or from a resume cursor
+@app.get("/export/{user_id}", dependencies=[Depends(require_session_always)])
+async def export_route(user_id: str, start: datetime = None, end: datetime = None, cursor: str = None):
+    if cursor:
+        try:
+            decode_export_cursor(cursor)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"message": "Invalid cursor"})
+    return StreamingResponse(export_user_data(user_id=user_id, start=start, end=end, cursor=cursor), media_type="application/x-ndjson")
+
 # Give reply
 @app.post("/generate_reply")
-async def generate_text(data: InputData, db: Session = Depends(get_db)):
+async def generate_text(data: InputData, request: Request):
     start = time.time()
     # try:
     user_input = data.utterance
     user_name = data.user_name
     user_id = data.user_id
+    authorize(request, user_id)
 
     print(user_id)
     print(user_input)
 
-    conversation_history = read_conversation(user_id=user_id, db=db)
-    print(colored(f"conversation_history : {conversation_history}", 'yellow'))
+    # Decides which context generate_reply_1 loads alongside memory and summary
+    intent = classify_intent(user_input)
 
     if user_input:
 
-        reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, conversation=conversation_history, db=db)
-        add_conversation(user_id=user_id, role=user_name, message=user_input, db=db)
-        add_conversation(user_id=user_id, role=buddy_name, message=reply, db=db)
+        reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, intent=intent)
+        await add_conversation_turn(user_id=user_id, user_role=user_name, user_message=user_input, buddy_role=buddy_name, buddy_message=reply)
         if asyncio.iscoroutine(reply):
             reply = asyncio.run(reply)
         print(reply)
@@ -114,6 +179,35 @@ async def generate_text(data: InputData, db: Session = Depends(get_db)):
     # except Exception as e:
     #     return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": "Internal Server Error"})
 
+# Give reply, streamed token by token as Server-Sent Events
+@app.post("/generate_reply_stream")
+async def generate_text_stream(data: InputData, request: Request):
+    user_input = data.utterance
+    user_name = data.user_name
+    user_id = data.user_id
+    authorize(request, user_id)
+
+    if not user_input:
+        return JSONResponse(status_code=400, content={"message": "Invalid input"})
+
+    async def event_stream():
+        start = time.time()
+        intent = classify_intent(user_input)
+
+        tokens = []
+        async for token in generate_reply_stream(user_utterance=user_input, user_id=user_id, user_name=user_name, intent=intent):
+            if not tokens:
+                print(f"Time to first token: {time.time()-start}")
+            tokens.append(token)
+            yield format_sse({"token": token})
+
+        reply = "".join(tokens).strip()
+        await add_conversation_turn(user_id=user_id, user_role=user_name, user_message=user_input, buddy_role=buddy_name, buddy_message=reply)
+        yield format_sse({"message": reply}, event="done")
+        print(f"Time Elapsed: {time.time()-start}")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 class ContinuousInputData(BaseModel):
     transcription: str
     question: str
@@ -121,45 +215,59 @@ class ContinuousInputData(BaseModel):
     user_name: str
     character: str = None
 
-@app.post("/upload_document/{user_id}")
+@app.post("/upload_document/{user_id}", dependencies=[Depends(require_session)])
 async def upload_document(user_id: str, file: UploadFile = File(...)):
-    """Endpoint to upload a text document for a user."""
+    """Endpoint to upload a document (.txt, .md or .pdf) for a user; it is streamed to disk, stored once per content and chunked once, here."""
     try:
-        contents = await file.read()
-        docs_dir = os.path.join(global_path, 'documents', user_id)
-        os.makedirs(docs_dir, exist_ok=True)
-        file_path = os.path.join(docs_dir, file.filename)
-        with open(file_path, 'wb') as f:
-            f.write(contents)
-        return JSONResponse(status_code=200, content={"message": f"Document '{file.filename}' uploaded successfully for user {user_id}"})
+        # Extraction and chunking happen at upload, so replies only ever read the chunk store
+        entry, unchanged = await receive_upload(user_id, file.filename, file)
+        if unchanged:
+            return JSONResponse(status_code=200, content={"message": f"Document '{entry['filename']}' is unchanged for user {user_id}", "chunks": entry['chunks']})
+        context_cache.written(user_id, 'documents')
+        return JSONResponse(status_code=200, content={"message": f"Document '{entry['filename']}' uploaded successfully for user {user_id}", "chunks": entry['chunks']})
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"message": str(e)})
+    except DocumentError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
     except Exception:
         return JSONResponse(status_code=500, content={"message": "Internal Server Error"})
 
+# Delete an uploaded document and its chunks
+@app.delete("/upload_document/{user_id}/{filename}", dependencies=[Depends(require_session)])
+async def delete_document_route(user_id: str, filename: str):
+    filename = os.path.basename(filename)
+    removed = await asyncio.to_thread(delete_document, user_id, filename)
+    removed = await asyncio.to_thread(remove_upload, user_id, filename) or removed
+    if not removed:
+        raise HTTPException(status_code=404, detail="Document not found")
+    context_cache.written(user_id, 'documents')
+    return {"message": f"Document '{filename}' deleted for user {user_id}"}
+
 # Generate audio
 @app.post("/generate_audio")
-async def generate_audio(data: InputData, db: Session = Depends(get_db)):
+async def generate_audio(data: InputData, request: Request):
     start = time.time()
     user_input = data.utterance
     user_name = data.user_name
     user_id = data.user_id
+    authorize(request, user_id)
 
     print(user_id)
     print(user_input)
 
-    conversation_history = read_conversation(user_id=user_id, db=db)
-    print(colored(f"conversation_history : {conversation_history}", 'yellow'))
+    # Decides which context generate_reply_1 loads alongside memory and summary
+    intent = classify_intent(user_input)
 
     if user_input:
-        reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, conversation=conversation_history, db=db)
-        add_conversation(user_id=user_id, role=user_name, message=user_input, db=db)
-        add_conversation(user_id=user_id, role=buddy_name, message=reply, db=db)
+        reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, intent=intent)
+        await add_conversation_turn(user_id=user_id, user_role=user_name, user_message=user_input, buddy_role=buddy_name, buddy_message=reply)
 
         if asyncio.iscoroutine(reply):
             reply = asyncio.run(reply)
         print(reply)
 
         # Google Text-to-Speech implementation
-        speech, audio_type = generate_text_to_speech(reply)
+        speech, audio_type = await generate_text_to_speech(reply)
         
         zip_stream = create_zip_stream(reply, speech, audio_type)
 
@@ -171,25 +279,23 @@ async def generate_audio(data: InputData, db: Session = Depends(get_db)):
         return JSONResponse(status_code=400, content={"message": "Invalid input"})
 
 @app.post("/generate_response_continuous")
-async def generate_response_continuous(data: ContinuousInputData, db: Session = Depends(get_db)):
+async def generate_response_continuous(data: ContinuousInputData, request: Request):
     start = time.time()
     user_input = data.question
     user_name = data.user_name
     user_id = data.user_id
+    authorize(request, user_id)
 
-    conversation_history = read_conversation(user_id=user_id, db=db)
-    # Append transcription if available
-    if data.transcription:
-        conversation_history += f"\n{user_name}: {data.transcription}"
+    intent = classify_intent(user_input)
 
-    reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, conversation=conversation_history, db=db)
-    add_conversation(user_id=user_id, role=user_name, message=user_input, db=db)
-    add_conversation(user_id=user_id, role=buddy_name, message=reply, db=db)
+    # The transcription gets its own token budget in the prompt
+    reply = await generate_reply_1(user_utterance=user_input, user_id=user_id, user_name=user_name, transcript=data.transcription or "", intent=intent)
+    await add_conversation_turn(user_id=user_id, user_role=user_name, user_message=user_input, buddy_role=buddy_name, buddy_message=reply)
 
     if asyncio.iscoroutine(reply):
         reply = asyncio.run(reply)
 
-    speech, audio_type = generate_text_to_speech(reply)
+    speech, audio_type = await generate_text_to_speech(reply)
     zip_stream = create_zip_stream(reply, speech, audio_type)
 
     end = time.time()
@@ -200,27 +306,25 @@ async def generate_response_continuous(data: ContinuousInputData, db: Session =
 
 @app.post("/generate_response_continuous_v2")
 async def generate_response_continuous_v2(
+    request: Request,
     transcription: str = Form(...),
     question: str = Form(...),
     user_id: str = Form(...),
     user_name: str = Form(...),
     character: str = Form(None),
-    audio_file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    audio_file: UploadFile = File(...)
 ):
+    authorize(request, user_id)
     start = time.time()
-    conversation_history = read_conversation(user_id=user_id, db=db)
-    if transcription:
-        conversation_history += f"\n{user_name}: {transcription}"
+    intent = classify_intent(question)
 
-    reply = await generate_reply_1(user_utterance=question, user_id=user_id, user_name=user_name, conversation=conversation_history, db=db)
-    add_conversation(user_id=user_id, role=user_name, message=question, db=db)
-    add_conversation(user_id=user_id, role=buddy_name, message=reply, db=db)
+    reply = await generate_reply_1(user_utterance=question, user_id=user_id, user_name=user_name, transcript=transcription or "", intent=intent)
+    await add_conversation_turn(user_id=user_id, user_role=user_name, user_message=question, buddy_role=buddy_name, buddy_message=reply)
 
     if asyncio.iscoroutine(reply):
         reply = asyncio.run(reply)
 
-    speech, audio_type = generate_text_to_speech(reply)
+    speech, audio_type = await generate_text_to_speech(reply)
     zip_stream = create_zip_stream(reply, speech, audio_type)
 
     end = time.time()
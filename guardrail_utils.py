@@ -1,48 +1,93 @@
 from pydantic import BaseModel, ValidationError
+import asyncio
+import re
 from typing import List, Dict, Any
 from dotenv import load_dotenv
-from utilities.utils import load_text_file
+from utilities.core_utils import load_text_file, load_config, estimate_call_tokens
 from utilities.llm_utils import openai_guardrail, GuardRailResponse
+from utilities.cache_utils import llm_cache
+from utilities.limiter_utils import limiter
+
+config = load_config()
 
 
 class GuardRail:
-    def __init__(self, sensitive_topics: List[str]):
+    def __init__(self, sensitive_topics: List[str], topic_keywords: Dict[str, List[str]] = None):
         self.sensitive_topics = sensitive_topics
+        self.system_prompt = load_text_file('utilities/prompts/guardrail.txt').format(sensitive_topics=', '.join(self.sensitive_topics))
+
+        # Local pre-filter: one compiled alternation over every topic name and
+        # its keywords, each also matching its plural and inflected forms
+        # ("muslims", "palestinians", "religions"). Text with no match is
+        # cleared without an LLM call; anything that matches still goes to the
+        # LLM for the real decision.
+        topic_keywords = topic_keywords or {}
+        phrases = set()
+        for topic in sensitive_topics:
+            phrases.add(topic.lower())
+            phrases.update(keyword.lower() for keyword in topic_keywords.get(topic, []))
+        alternation = "|".join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+        inflections = r"(?:s|es|'s|ism|isms|ist|ists|ic|ed|ing|er|ers)?"
+        self.prefilter_pattern = re.compile(rf"\b(?:{alternation}){inflections}\b", re.IGNORECASE)
+
+    def prefilter(self, text: str) -> List[str]:
+        """Return the sensitive phrases found in text; an empty list means it is clearly safe."""
+        return sorted({match.lower() for match in self.prefilter_pattern.findall(text)})
+
+    async def check(self, text: str) -> Dict[str, Any]:
+        """Classify text, consulting the LLM only when the pre-filter finds a sensitive phrase."""
+        matches = self.prefilter(text)
+        if not matches:
+            return {"is_sensitive": False, "explanation": "No sensitive topics mentioned"}
 
-    def validate(self, text: str) -> Dict[str, Any]:
         prompt = self._create_prompt(text)
-        guard_response = openai_guardrail(prompt)
+        try:
+            guard_response = await llm_cache.get_or_call('guardrail', 'openai', prompt, 'guardrail', lambda: self._limited_guardrail(prompt))
+        except Exception as e:
+            # A failed check is never cached; guardrail.fail_closed picks the verdict for this request only
+            print(f"Error in guardrail check: {str(e)}")
+            if config['guardrail']['fail_closed']:
+                return {"is_sensitive": True, "explanation": f"Guardrail unavailable; mentions {', '.join(matches)}"}
+            return {"is_sensitive": False, "explanation": "Guardrail unavailable"}
         print(guard_response)
+        return {"is_sensitive": guard_response['is_sensitive'], "explanation": guard_response.get('explanation', f"Mentions {', '.join(matches)}")}
+
+    async def validate(self, text: str) -> Dict[str, Any]:
+        guard_response = await self.check(text)
         if guard_response['is_sensitive']:
-            try:
-                if guard_response['is_sensitive']:
-                    raise Exception(f"Sensitive content detected: {guard_response['explanation']}")
-                return {"is_sensitive": False, "explanation": guard_response['explanation']}
-            except ValidationError as e:
-                print(f"Validation error: {str(e)}")
-                raise Exception("Failed to validate the response")
-        else:
-            raise Exception("Failed to validate the response")
+            raise Exception(f"Sensitive content detected: {guard_response['explanation']}")
+        return guard_response
+
+    async def _limited_guardrail(self, prompt: List[Dict[str, str]]) -> Dict[str, Any]:
+        async with limiter.slot('openai', tokens=estimate_call_tokens('openai', prompt)):
+            return await openai_guardrail(prompt)
 
     def _create_prompt(self, text: str) -> List[Dict[str, str]]:
         prompt = [
-            {"role": "system", "content": load_text_file('utilities/prompts/guardrail.txt').format(sensitive_topics=', '.join(self.sensitive_topics))},
+            {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": f"Please analyze the following text:\n\n{text}"}
         ]
         return prompt
 
+# Guardrail for user utterances, built from the configured sensitive topics
+guard = GuardRail(sensitive_topics=config['sensitive_topics'], topic_keywords=config['guardrail']['topic_keywords'])
+
 # Usage example
-guard = GuardRail(sensitive_topics=["politics", "religion", "violence"])
-
-# Test passing response
-try:
-    result = guard.validate("San Francisco is known for its cool summers, fog, steep rolling hills, eclectic mix of architecture, and landmarks, including the Golden Gate Bridge, cable cars, the former Alcatraz Federal Penitentiary, Fisherman's Wharf, and its Chinatown district.")
-    print("Passed validation:", result)
-except Exception as e:
-    print("Failed validation:", str(e))
-
-# Test failing response
-try:
-    guard.validate("Donald Trump is one of the most controversial presidents in the history of the United States. He has been impeached twice, and is running for re-election in 2024.")
-except Exception as e:
-    print("Failed validation:", str(e))
\ No newline at end of file
+async def main():
+    guard = GuardRail(sensitive_topics=["politics", "religion", "violence"], topic_keywords={"politics": ["president", "impeached", "election"]})
+
+    # Test passing response
+    try:
+        result = await guard.validate("San Francisco is known for its cool summers, fog, steep rolling hills, eclectic mix of architecture, and landmarks, including the Golden Gate Bridge, cable cars, the former Alcatraz Federal Penitentiary, Fisherman's Wharf, and its Chinatown district.")
+        print("Passed validation:", result)
+    except Exception as e:
+        print("Failed validation:", str(e))
+
+    # Test failing response
+    try:
+        await guard.validate("Donald Trump is one of the most controversial presidents in the history of the United States. He has been impeached twice, and is running for re-election in 2024.")
+    except Exception as e:
+        print("Failed validation:", str(e))
+
+if __name__ == "__main__":
+    asyncio.run(main())
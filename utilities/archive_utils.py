@@ -0,0 +1,187 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/archive_utils.py
+Description: Implements conversation retention by archiving old turns into compressed per-user blocks
+"""
+
+import argparse
+import asyncio
+import fcntl
+import zlib
+from sqlalchemy import delete
+from utilities.db_utils import *
+from utilities.context_utils import context_cache
+
+config = load_config()
+
+
+def encode_block(records: list, level: int) -> bytes:
+    rows = [[record.id, record.role, record.message, record.timestamp.isoformat()] for record in records]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), level)
+
+def decode_block(data: bytes) -> list:
+    """Return the block's rows as dicts shaped like Conversation columns."""
+    return [
+        {"id": row_id, "role": role, "message": message, "timestamp": datetime.fromisoformat(timestamp)}
+        for row_id, role, message, timestamp in json.loads(zlib.decompress(data).decode('utf-8'))
+    ]
+
+
+class ConversationArchiver:
+    """Moves conversation turns older than horizon_days out of the hot table.
+
+    Each user's old turns are packed block_rows at a time into zlib-compressed
+    JSON blocks in conversation_archive. The block insert and the row delete
+    share a transaction, so a turn is always in exactly one of the two tables.
+    Blocks record their id and time range, which is enough to export a range or
+    restore the rows with their original ids. With require_summarized, turns the
+    rolling summary has not folded in yet stay in the hot table.
+    """
+
+    def __init__(self, archive_config: dict):
+        self.enabled = archive_config['enabled']
+        self.horizon_days = archive_config['horizon_days']
+        self.block_rows = archive_config['block_rows']
+        self.compression_level = archive_config['compression_level']
+        self.require_summarized = archive_config['require_summarized']
+        self.interval = archive_config['interval_seconds']
+        self.max_users_per_run = archive_config['max_users_per_run']
+        self.lock_path = os.path.join(global_path, archive_config['lock_path'])
+        self.task = None
+
+    async def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.scheduler())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def scheduler(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(colored(f"Conversation archival failed: {e!r}", 'red'))
+
+    async def run_once(self) -> int:
+        """Archive every user's expired turns. Returns the number of rows moved."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is already archiving
+                return 0
+
+            cutoff = datetime.utcnow() - timedelta(days=self.horizon_days)
+            # Pick only users with something archive_block will move, or the same unarchivable users would fill every run
+            query = select(Conversation.user_id).where(Conversation.timestamp < cutoff)
+            if self.require_summarized:
+                query = query.join(SummaryProgress, SummaryProgress.user_id == Conversation.user_id).where(
+                    Conversation.id <= SummaryProgress.summarized_through_id
+                )
+            async with SessionLocal() as db:
+                result = await db.execute(query.distinct().limit(self.max_users_per_run))
+                user_ids = list(result.scalars().all())
+
+            archived = 0
+            for user_id in user_ids:
+                archived += await self.archive_user(user_id, cutoff)
+            if archived:
+                print(colored(f"Archived {archived} conversation rows for {len(user_ids)} users", 'green'))
+            return archived
+
+    async def archive_user(self, user_id: str, cutoff: datetime) -> int:
+        archived = 0
+        while True:
+            async with SessionLocal() as db:
+                count = await self.archive_block(db, user_id, cutoff)
+            if not count:
+                break
+            archived += count
+            if count < self.block_rows:
+                break
+        if archived:
+            context_cache.written(user_id, 'conversation')
+        return archived
+
+    async def archive_block(self, db: AsyncSession, user_id: str, cutoff: datetime) -> int:
+        query = select(Conversation).where(Conversation.user_id == user_id, Conversation.timestamp < cutoff)
+        if self.require_summarized:
+            progress = (await db.execute(select(SummaryProgress).where(SummaryProgress.user_id == user_id))).scalars().first()
+            query = query.where(Conversation.id <= (progress.summarized_through_id if progress else 0))
+        records = (await db.execute(query.order_by(Conversation.timestamp, Conversation.id).limit(self.block_rows))).scalars().all()
+        if not records:
+            return 0
+
+        db.add(ConversationArchive(
+            user_id=user_id,
+            first_id=min(record.id for record in records),
+            last_id=max(record.id for record in records),
+            first_timestamp=records[0].timestamp,
+            last_timestamp=records[-1].timestamp,
+            row_count=len(records),
+            data=encode_block(records, self.compression_level)
+        ))
+        await db.execute(delete(Conversation).where(Conversation.id.in_([record.id for record in records])))
+        await db.commit()
+        return len(records)
+
+
+# Stream a user's archived rows, oldest first, optionally limited to [start, end) and to ids after after_id
+async def read_archived_conversation(db: AsyncSession, user_id: str, start: datetime = None, end: datetime = None, after_id: int = None):
+    query = select(ConversationArchive).where(ConversationArchive.user_id == user_id)
+    if after_id is not None:
+        query = query.where(ConversationArchive.last_id > after_id)
+    if start is not None:
+        query = query.where(ConversationArchive.last_timestamp >= start)
+    if end is not None:
+        query = query.where(ConversationArchive.first_timestamp < end)
+    result = await db.stream_scalars(query.order_by(ConversationArchive.first_timestamp, ConversationArchive.id))
+    async for block in result:
+        for row in decode_block(block.data):
+            if after_id is not None and row["id"] <= after_id:
+                continue
+            if (start is None or row["timestamp"] >= start) and (end is None or row["timestamp"] < end):
+                yield row
+
+# Move a user's archived rows back into the conversation table with their original ids
+async def restore_archived_conversation(db: AsyncSession, user_id: str) -> int:
+    blocks = (await db.execute(select(ConversationArchive).where(ConversationArchive.user_id == user_id))).scalars().all()
+    restored = 0
+    for block in blocks:
+        rows = [dict(row, user_id=user_id) for row in decode_block(block.data)]
+        await db.execute(insert(Conversation), rows)
+        await db.delete(block)
+        restored += len(rows)
+    await db.commit()
+    context_cache.written(user_id, 'conversation')
+    return restored
+
+
+conversation_archiver = ConversationArchiver(config['conversation_archive'])
+
+# Run one archival pass, or restore a user's archive
+async def main():
+    parser = argparse.ArgumentParser(description="Archive old conversation turns, or restore a user's archive.")
+    parser.add_argument('--restore', metavar='USER_ID', help="move USER_ID's archived turns back into the conversation table")
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        if args.restore:
+            async with SessionLocal() as db:
+                print(f"Restored {await restore_archived_conversation(db, args.restore)} rows")
+        else:
+            print(f"Archived {await conversation_archiver.run_once()} rows")
+    finally:
+        context_cache.close()
+        await close_db()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/auth_utils.py
+Description: Implements off-loop password hashing and signed session tokens
+"""
+
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+from fastapi import HTTPException, Request
+from werkzeug.security import generate_password_hash, check_password_hash
+from utilities.core_utils import *
+
+config = load_config()
+auth_config = config['auth']
+
+
+#Password hashing =======================================================================
+
+# Hashing is deliberately slow, so it runs in a small process pool instead of
+# on the event loop. The pool is created on first use, after gunicorn forks.
+hash_executor = None
+hash_slots = None
+
+def get_hash_executor():
+    global hash_executor, hash_slots
+    if hash_executor is None:
+        # Forking a process that already runs threads (to_thread, the Bedrock executor) can copy held locks
+        hash_executor = concurrent.futures.ProcessPoolExecutor(max_workers=auth_config['hash_workers'], mp_context=multiprocessing.get_context('forkserver'))
+        # Bounds the backlog too: a login burst waits here rather than piling up in the pool
+        hash_slots = asyncio.Semaphore(auth_config['hash_workers'] * auth_config['hash_queue_per_worker'])
+    return hash_executor
+
+async def run_hash(func, *args):
+    executor = get_hash_executor()
+    async with hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def hash_password(password: str) -> str:
+    return await run_hash(generate_password_hash, password, auth_config['hash_method'], auth_config['salt_length'])
+
+async def verify_password(password_hash: str, password: str) -> bool:
+    return await run_hash(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash: str) -> bool:
+    """True when the hash was made with other parameters than the configured ones."""
+    return password_hash.split('$', 1)[0] != auth_config['hash_method']
+
+def close_hash_executor():
+    if hash_executor is not None:
+        hash_executor.shutdown(wait=False)
+
+
+#Session tokens =========================================================================
+
+# Every worker must sign with the same secret, or a token issued by one fails on the others
+session_secret = os.getenv('SESSION_SECRET')
+session_key = session_secret.encode('utf-8') if session_secret else None
+
+def require_session_secret():
+    """Fail startup when SESSION_SECRET is missing; called from the app's startup hook."""
+    if session_key is None:
+        raise RuntimeError("SESSION_SECRET is not set; it must be the same for every worker, since session tokens are signed with it")
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def issue_session_token(user_id: str) -> str:
+    """Return a '<payload>.<signature>' token for user_id, valid for session_ttl_seconds."""
+    require_session_secret()
+    now = int(time.time())
+    payload = b64encode(json.dumps({"uid": user_id, "iat": now, "exp": now + auth_config['session_ttl_seconds']}, separators=(',', ':')).encode('utf-8'))
+    signature = b64encode(hmac.new(session_key, payload.encode('ascii'), hashlib.sha256).digest())
+    return f"{payload}.{signature}"
+
+def verify_session_token(token: str):
+    """Return the token's user_id, or None if it is malformed, forged or expired."""
+    require_session_secret()
+    try:
+        payload, signature = token.split('.')
+        expected = b64encode(hmac.new(session_key, payload.encode('ascii'), hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected):
+            return None
+        claims = json.loads(b64decode(payload))
+    except (ValueError, UnicodeError):
+        return None
+    if claims.get('exp', 0) < time.time():
+        return None
+    return claims.get('uid')
+
+def authorize(request: Request, user_id: str, always: bool = False):
+    """Require a session token for user_id when config['auth']['enforce_sessions'] is on, or always with always=True.
+
+    Tokens are read from 'Authorization: Bearer <token>'. Checking one is a
+    single HMAC, so authenticated calls never touch the password hash.
+    """
+    if not (always or auth_config['enforce_sessions']):
+        return
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else ''
+    if verify_session_token(token) != user_id:
+        raise HTTPException(status_code=401, detail="Invalid or expired session token")
+
+# Dependency for routes with a {user_id} path parameter
+async def require_session(request: Request, user_id: str):
+    authorize(request, user_id)
+
+# Dependency for routes that hand out a user's whole history, whatever enforce_sessions says
+async def require_session_always(request: Request, user_id: str):
+    authorize(request, user_id, always=True)
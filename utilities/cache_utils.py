@@ -0,0 +1,168 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/cache_utils.py
+Description: Implements an LLM response cache with LRU and TTL eviction
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from utilities.core_utils import *
+
+config = load_config()
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache; entries also expire after their TTL."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, ttl: float):
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskCacheBackend:
+    """SQLite-file cache shared by every worker on the host, evicted by TTL and least-recent access."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self.connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now)
+            )
+            self.connection.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            self.connection.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+def cacheable(result) -> bool:
+    # Provider wrappers mark results they fell back to after swallowing an error with 'fallback'
+    return not (isinstance(result, dict) and result.get('fallback'))
+
+
+class LLMCache:
+    """Caches LLM results per call site, keyed on a canonical hash of model, prompt and structured mode.
+
+    Call sites opt in through config['llm_cache']['sites']; a site that is not
+    listed (or a disabled cache) always goes straight to the provider.
+    """
+
+    def __init__(self, cache_config: dict):
+        self.enabled = cache_config['enabled']
+        self.sites = cache_config['sites']
+        if cache_config['backend'] == 'disk':
+            self.backend = DiskCacheBackend(os.path.join(global_path, cache_config['disk_path']), cache_config['max_entries'])
+        else:
+            self.backend = MemoryCacheBackend(cache_config['max_entries'])
+        self.counters = {site: {'hits': 0, 'misses': 0} for site in self.sites}
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        return " ".join(text.split()).casefold()
+
+    def make_key(self, model_name: str, prompt_list: list, structured, normalize: bool) -> str:
+        messages = []
+        for message in prompt_list:
+            content = message['content']
+            if normalize:
+                content = self.normalize_text(content)
+            messages.append([message['role'], content])
+
+        # Pin the concrete model, so changing it in config never serves stale results
+        model = config['openai_model'] if model_name == 'openai' else model_name
+        canonical = json.dumps([model, str(structured), messages], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    async def get_or_call(self, site: str, model_name: str, prompt_list: list, structured, call, cacheable=cacheable, key_prompt: list = None):
+        """Return the cached result for this call site, or await call() and cache what it returns.
+
+        Results rejected by cacheable(result) are returned but not stored, so a
+        transient failure is not served as the answer for the rest of the TTL.
+        key_prompt, when given, is hashed instead of prompt_list: the part of
+        the prompt that actually decides the result. The key names the
+        requested model even if failover answered; every provider gets the
+        same prompt, so the answer stands for the call as made.
+        """
+        site_config = self.sites.get(site)
+        if not self.enabled or site_config is None:
+            return await call()
+
+        key = f"{site}:{self.make_key(model_name, key_prompt or prompt_list, structured, site_config['normalize'])}"
+        cached = await self.run(self.backend.get, key)
+        if cached is not None:
+            self.counters[site]['hits'] += 1
+            return json.loads(cached)
+
+        self.counters[site]['misses'] += 1
+        result = await call()
+        if cacheable(result):
+            await self.run(self.backend.set, key, json.dumps(result), site_config['ttl_seconds'])
+        return result
+
+    async def run(self, func, *args):
+        # Disk lookups leave the event loop; in-process ones are cheap enough to run inline
+        if isinstance(self.backend, DiskCacheBackend):
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def stats(self) -> dict:
+        sites = {}
+        for site, counter in self.counters.items():
+            total = counter['hits'] + counter['misses']
+            sites[site] = dict(counter, hit_rate=counter['hits'] / total if total else 0.0)
+        return {'backend': type(self.backend).__name__, 'entries': len(self.backend), 'sites': sites}
+
+
+llm_cache = LLMCache(config['llm_cache'])
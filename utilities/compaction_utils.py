@@ -0,0 +1,183 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/compaction_utils.py
+Description: Implements periodic compaction of each user's memory fragments into consolidated memories
+"""
+
+import asyncio
+import fcntl
+from sqlalchemy import delete, func
+from utilities.db_utils import *
+from utilities.context_utils import context_cache
+from utilities.utils import model_response
+
+config = load_config()
+
+
+class MemoryCompactor:
+    """Merges the Memory fragments synthesize_memory keeps adding into a few consolidated memories.
+
+    Progress is tracked per user in memory_compaction.compacted_through: every
+    fragment stored after that timestamp is still unmerged. A run picks the
+    users with at least min_new_fragments unmerged, compacts up to
+    max_concurrency of them at a time, and commits each batch of fragments
+    together with the new watermark, so an interrupted run resumes where it
+    stopped. Only one worker on the host runs compaction at a time.
+    """
+
+    def __init__(self, compaction_config: dict):
+        self.enabled = compaction_config['enabled']
+        self.interval = compaction_config['interval_seconds']
+        self.min_new_fragments = compaction_config['min_new_fragments']
+        self.batch_fragments = compaction_config['batch_fragments']
+        self.max_memories = compaction_config['max_memories']
+        self.max_users_per_run = compaction_config['max_users_per_run']
+        self.max_concurrency = compaction_config['max_concurrency']
+        self.lock_path = os.path.join(global_path, compaction_config['lock_path'])
+        self.task = None
+
+    async def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.scheduler())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def scheduler(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(colored(f"Memory compaction failed: {e!r}", 'red'))
+
+    async def run_once(self) -> int:
+        """Compact every user with enough new fragments. Returns the number of fragments merged."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is already compacting
+                return 0
+
+            async with SessionLocal() as db:
+                user_ids = await self.pending_users(db)
+            if not user_ids:
+                return 0
+
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def compact(user_id):
+                async with semaphore:
+                    try:
+                        return await self.compact_user(user_id)
+                    except Exception as e:
+                        # Progress up to the last committed batch is kept; the rest is retried next run
+                        print(colored(f"Memory compaction for {user_id} failed: {e!r}", 'yellow'))
+                        return 0
+
+            merged = sum(await asyncio.gather(*(compact(user_id) for user_id in user_ids)))
+            print(colored(f"Memory compaction merged {merged} fragments for {len(user_ids)} users", 'green'))
+            return merged
+
+    async def pending_users(self, db: AsyncSession) -> list:
+        result = await db.execute(
+            select(Memory.user_id)
+            .outerjoin(MemoryCompaction, MemoryCompaction.user_id == Memory.user_id)
+            .where(or_(MemoryCompaction.compacted_through.is_(None), Memory.timestamp > MemoryCompaction.compacted_through))
+            .group_by(Memory.user_id)
+            .having(func.count(Memory.id) >= self.min_new_fragments)
+            .order_by(func.count(Memory.id).desc())
+            .limit(self.max_users_per_run)
+        )
+        return list(result.scalars().all())
+
+    async def compact_user(self, user_id: str) -> int:
+        """Merge user_id's unmerged fragments, one committed batch at a time."""
+        merged = 0
+        while True:
+            async with SessionLocal() as db:
+                count = await self.compact_batch(db, user_id)
+            if not count:
+                break
+            merged += count
+            # Memories changed under the retriever's index
+            context_cache.written(user_id, 'memory_synced')
+            if count < self.batch_fragments:
+                break
+        return merged
+
+    async def compact_batch(self, db: AsyncSession, user_id: str) -> int:
+        watermark = (await db.execute(select(MemoryCompaction).where(MemoryCompaction.user_id == user_id))).scalars().first()
+
+        consolidated = []
+        fragments_query = select(Memory).where(Memory.user_id == user_id)
+        if watermark is not None:
+            consolidated = (await db.execute(
+                select(Memory).where(Memory.user_id == user_id, Memory.timestamp <= watermark.compacted_through).order_by(Memory.timestamp, Memory.id)
+            )).scalars().all()
+            fragments_query = fragments_query.where(Memory.timestamp > watermark.compacted_through)
+        fragments = (await db.execute(fragments_query.order_by(Memory.timestamp, Memory.id).limit(self.batch_fragments))).scalars().all()
+        if not fragments:
+            return 0
+
+        user = await get_user_by_id(user_id=user_id, db=db)
+        memories = await self.consolidate(
+            user_name=user.name if user else "the user",
+            consolidated=[row.memory for row in consolidated],
+            fragments=[row.memory for row in fragments]
+        )
+        if not memories:
+            raise ValueError("Compaction returned no memories")
+
+        # Merged memories take the newest fragment's time, keeping their recency and the watermark consistent
+        compacted_through = fragments[-1].timestamp
+        await db.execute(delete(Memory).where(Memory.id.in_([row.id for row in consolidated + fragments])))
+        await db.execute(insert(Memory), [
+            {"user_id": user_id, "memory": memory, "timestamp": compacted_through} for memory in memories
+        ])
+        if watermark is None:
+            db.add(MemoryCompaction(user_id=user_id, compacted_through=compacted_through))
+        else:
+            watermark.compacted_through = compacted_through
+            watermark.compacted_at = datetime.utcnow()
+        await db.commit()
+        return len(fragments)
+
+    async def consolidate(self, user_name: str, consolidated: list, fragments: list) -> list:
+        final_prompt = load_text_file('utilities/prompts/memory_compaction.txt').format(
+            user_name=user_name,
+            consolidated="\n".join(f"- {memory}" for memory in consolidated) or "(none yet)",
+            fragments="\n".join(f"- {memory}" for memory in fragments),
+            max_memories=self.max_memories
+        )
+        preamble = load_text_file('utilities/prompts/memory_preamble.txt')
+        prompt_list = [{"role": "system", "content": preamble}, {"role": "user", "content": final_prompt}]
+
+        reply = await model_response(model_name=memory_model_name, prompt_list=prompt_list)
+        try:
+            parsed = json.loads(reply[reply.index('{'):reply.rindex('}') + 1])
+        except ValueError:
+            raise ValueError(f"Compaction reply is not JSON: {reply[:200]!r}")
+        memories = [memory.strip() for memory in parsed.get('memories', []) if isinstance(memory, str) and memory.strip()]
+        return memories[:self.max_memories]
+
+
+memory_compactor = MemoryCompactor(config['memory_compaction'])
+
+# Run one compaction pass, e.g. from cron
+async def main():
+    await init_db()
+    try:
+        await memory_compactor.run_once()
+    finally:
+        context_cache.close()
+        await close_db()
+
+if __name__ == "__main__":
+    asyncio.run(main())
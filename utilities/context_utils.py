@@ -0,0 +1,243 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/context_utils.py
+Description: Implements a per-user cache of prompt context with write-through invalidation
+"""
+
+import concurrent.futures
+import hashlib
+import sys
+import threading
+from collections import OrderedDict, deque
+from utilities.core_utils import *
+
+config = load_config()
+
+MISSING = object()
+# Stamp name for writes that touch all of a user's data
+ALL_FIELDS = 'all'
+
+
+class ContextCache:
+    """Keeps each active user's summary, conversation tail, documents and memory state in process.
+
+    Entries are evicted least-recently-used once max_users or max_bytes is
+    exceeded, and dropped after idle_ttl_seconds without a turn. Writers update
+    or invalidate their field here (write-through), so consecutive turns are
+    served without touching the database.
+
+    Other workers on the host learn about writes through per-user, per-field
+    stamp files: every write replaces the stamp of the field it touched, and a
+    cached field whose recorded stamp no longer matches its file is discarded on
+    its next lookup, leaving the user's other fields in place. Stamp files are
+    written in batches on a background thread, never on the caller's.
+    """
+
+    def __init__(self, cache_config: dict):
+        self.enabled = cache_config['enabled']
+        self.max_users = cache_config['max_users']
+        self.max_bytes = cache_config['max_bytes']
+        self.idle_ttl = cache_config['idle_ttl_seconds']
+        self.cross_worker = cache_config['cross_worker_invalidation']
+        self.stamp_dir = os.path.join(global_path, cache_config['stamp_dir'])
+        if self.cross_worker:
+            os.makedirs(self.stamp_dir, exist_ok=True)
+        self.stamp_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='context-stamps') if self.cross_worker else None
+        self.stamp_lock = threading.Lock()
+        self.pending_stamps = set()
+        # (user_id, stamp name, stamp before, stamp after) for each replace done by the writer thread
+        self.bumped = deque()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    # ------------------------------------------------------------------
+    # Cross-worker stamps
+    # ------------------------------------------------------------------
+
+    def stamp_path(self, user_id: str, name: str) -> str:
+        return os.path.join(self.stamp_dir, f"{hashlib.sha1(user_id.encode('utf-8')).hexdigest()}.{name}")
+
+    def read_stamp(self, user_id: str, name: str = ALL_FIELDS):
+        if not self.cross_worker:
+            return None
+        try:
+            stat = os.stat(self.stamp_path(user_id, name))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def bump_stamp(self, user_id: str, name: str):
+        # Replacing the file gives it a new inode, so the stamp changes even within one mtime tick
+        path = self.stamp_path(user_id, name)
+        temp_path = f"{path}.{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            f.write(str(time.time()))
+        previous = self.read_stamp(user_id, name)
+        os.replace(temp_path, path)
+        self.bumped.append((user_id, name, previous, self.read_stamp(user_id, name)))
+
+    def queue_stamp(self, user_id: str, name: str):
+        """Schedule a bump of the stamp; writes queued while a batch is pending are coalesced into it."""
+        with self.stamp_lock:
+            schedule = not self.pending_stamps
+            self.pending_stamps.add((user_id, name))
+        if schedule:
+            self.stamp_executor.submit(self.write_stamps)
+
+    def write_stamps(self):
+        with self.stamp_lock:
+            batch, self.pending_stamps = self.pending_stamps, set()
+        for user_id, name in batch:
+            try:
+                self.bump_stamp(user_id, name)
+            except OSError as e:
+                print(colored(f"Failed to write context stamp for {user_id}: {e}", 'red'))
+
+    def apply_bumps(self):
+        """Adopt this worker's own stamp replaces, unless another worker replaced the stamp first."""
+        while self.bumped:
+            user_id, name, previous, stamp = self.bumped.popleft()
+            entry = self.entries.get(user_id)
+            if entry is not None and name in entry['stamps'] and entry['stamps'][name] == previous:
+                entry['stamps'][name] = stamp
+
+    def close(self):
+        """Write out queued stamps and stop the writer thread."""
+        if self.stamp_executor is not None:
+            self.stamp_executor.shutdown(wait=True)
+
+    # ------------------------------------------------------------------
+    # Entries
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def measure(value) -> int:
+        if isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(ContextCache.measure(item) for item in value)
+        if hasattr(value, 'message'):
+            return sys.getsizeof(value.message) + 64
+        return sys.getsizeof(value)
+
+    def entry(self, user_id: str, create: bool = False):
+        """Return the live entry for user_id, dropping it first if it went idle or all its data was rewritten."""
+        self.apply_bumps()
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            if time.monotonic() - entry['accessed_at'] > self.idle_ttl or entry['stamps'][ALL_FIELDS] != self.read_stamp(user_id):
+                self.drop(user_id)
+                entry = None
+        if entry is None and create:
+            entry = {'fields': {}, 'sizes': {}, 'stamps': {ALL_FIELDS: self.read_stamp(user_id)}, 'size': 0, 'generation': 0, 'accessed_at': time.monotonic()}
+            self.entries[user_id] = entry
+        if entry is not None:
+            entry['accessed_at'] = time.monotonic()
+            self.entries.move_to_end(user_id)
+        return entry
+
+    def drop(self, user_id: str):
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+    def discard(self, entry: dict, field: str):
+        if field in entry['fields']:
+            del entry['fields'][field]
+            size = entry['sizes'].pop(field)
+            entry['size'] -= size
+            self.total_bytes -= size
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_users or self.total_bytes > self.max_bytes):
+            user_id = next(iter(self.entries))
+            self.drop(user_id)
+            self.counters['evictions'] += 1
+
+    def get(self, user_id: str, field: str):
+        """Return the cached value, or MISSING."""
+        if not self.enabled:
+            return MISSING
+        entry = self.entry(user_id)
+        if entry is not None and field in entry['fields'] and entry['stamps'].get(field) != self.read_stamp(user_id, field):
+            # Another worker wrote this field; the rest of the entry is still good
+            self.discard(entry, field)
+        if entry is None or field not in entry['fields']:
+            self.counters['misses'] += 1
+            return MISSING
+        self.counters['hits'] += 1
+        return entry['fields'][field]
+
+    def set(self, user_id: str, field: str, value, generation: int = None):
+        """Cache value, unless a write happened since `generation` was read (the value may predate it)."""
+        if not self.enabled:
+            return
+        entry = self.entry(user_id, create=True)
+        if generation is not None and generation != entry['generation']:
+            return
+        if field not in entry['stamps']:
+            entry['stamps'][field] = self.read_stamp(user_id, field)
+        size = self.measure(value)
+        previous = entry['sizes'].get(field, 0)
+        entry['fields'][field] = value
+        entry['sizes'][field] = size
+        entry['size'] += size - previous
+        self.total_bytes += size - previous
+        self.evict()
+
+    def generation(self, user_id: str, field: str = None) -> int:
+        """Write counter to pass back to set() after a slow load of field.
+
+        Also records field's current stamp, so a write by another worker while
+        the load runs invalidates the value it returns.
+        """
+        if not self.enabled:
+            return 0
+        entry = self.entry(user_id, create=True)
+        if field is not None and field not in entry['fields']:
+            entry['stamps'][field] = self.read_stamp(user_id, field)
+        return entry['generation']
+
+    async def get_or_load(self, user_id: str, field: str, load):
+        """Return the cached field, or await load() and cache its result."""
+        value = self.get(user_id, field)
+        if value is not MISSING:
+            return value
+        generation = self.generation(user_id, field)
+        value = await load()
+        self.set(user_id, field, value, generation=generation)
+        return value
+
+    # ------------------------------------------------------------------
+    # Write-through
+    # ------------------------------------------------------------------
+
+    def written(self, user_id: str, field: str = None, update=None):
+        """Record a write to user_id's data.
+
+        update(old_value) -> new_value refreshes a cached field in place; without
+        it the field (or, with no field, every field) is invalidated. Other
+        workers see the write once the stamp writer thread gets to it.
+        """
+        if not self.enabled:
+            return
+        entry = self.entry(user_id)
+        if entry is not None:
+            entry['generation'] += 1
+            if field is None:
+                for name in list(entry['fields']):
+                    self.discard(entry, name)
+            elif field in entry['fields']:
+                if update is not None:
+                    self.set(user_id, field, update(entry['fields'][field]), generation=entry['generation'])
+                else:
+                    self.discard(entry, field)
+        if self.cross_worker:
+            self.queue_stamp(user_id, field or ALL_FIELDS)
+
+    def stats(self) -> dict:
+        total = self.counters['hits'] + self.counters['misses']
+        return dict(self.counters, users=len(self.entries), bytes=self.total_bytes, hit_rate=self.counters['hits'] / total if total else 0.0)
+
+
+context_cache = ContextCache(config['context_cache'])
@@ -15,6 +15,11 @@ from dotenv import load_dotenv
 from datetime import datetime
 import re
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 load_dotenv()
 
 def load_config(env="development"):
@@ -70,6 +75,109 @@ def truncate_conversation(conversation: str, word_limit: int = 1000) -> str:
     else:
         return ' '.join(words[-word_limit:])
 
+# ----------------------------------------------------------------------
+# Token accounting. Uses tiktoken when it is installed and falls back to a
+# ~4 characters-per-token estimate otherwise.
+# ----------------------------------------------------------------------
+
+prompt_budget = config['prompt_budget']
+tokenizer = None
+
+def get_tokenizer():
+    global tokenizer
+    if tokenizer is None and tiktoken is not None:
+        try:
+            tokenizer = tiktoken.get_encoding(prompt_budget['tokenizer'])
+        except Exception:
+            # Encoding files unavailable (e.g. offline); keep using the estimate
+            tokenizer = False
+    return tokenizer or None
+
+def count_tokens(text: str) -> int:
+    """Return the number of tokens in text."""
+    if not text:
+        return 0
+    encoder = get_tokenizer()
+    if encoder:
+        return len(encoder.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def truncate_tokens(text: str, max_tokens: int, from_end: bool = False) -> str:
+    """Cut text to at most max_tokens tokens, keeping the start (or the end if from_end)."""
+    if max_tokens <= 0:
+        return ""
+    encoder = get_tokenizer()
+    if encoder:
+        tokens = encoder.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoder.decode(tokens[-max_tokens:] if from_end else tokens[:max_tokens])
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[-max_chars:] if from_end else text[:max_chars]
+
+def pack_section(units: list, budget: int, from_end: bool = False):
+    """
+    Pack whole units (lines, paragraphs) into a token budget.
+
+    Args:
+    units (list): Text units in their natural order.
+    budget (int): Token budget for the section.
+    from_end (bool): Pack the most recent units first (for conversations).
+
+    Returns:
+    tuple: The packed text and the number of tokens it uses.
+    """
+    packed = []
+    used = 0
+    for unit in (reversed(units) if from_end else units):
+        cost = count_tokens(unit) + 1
+        if used + cost > budget:
+            if not packed:
+                # A single oversized unit still contributes what fits
+                unit = truncate_tokens(unit, budget - 1, from_end=from_end)
+                packed.append(unit)
+                used = count_tokens(unit) + 1
+            break
+        packed.append(unit)
+        used += cost
+    if from_end:
+        packed.reverse()
+    return "\n".join(packed), used
+
+def fit_max_tokens(model_name: str, prompt_list: list) -> int:
+    """Output-token limit for a call: the model's configured maximum, capped by what is left of its context window."""
+    prompt_tokens = sum(count_tokens(message['content']) + 4 for message in prompt_list)
+    available = prompt_budget['context_window'][model_name] - prompt_tokens - prompt_budget['safety_margin_tokens']
+    return max(1, min(prompt_budget['max_output_tokens'][model_name], available))
+
+def estimate_call_tokens(model_name: str, prompt_list: list) -> int:
+    """Upper bound on the tokens a call can consume, used for rate limiting."""
+    return sum(count_tokens(message['content']) + 4 for message in prompt_list) + fit_max_tokens(model_name, prompt_list)
+
+# ----------------------------------------------------------------------
+# Lexical terms shared by the memory and document retrievers
+# ----------------------------------------------------------------------
+
+token_pattern = re.compile(r"[a-z0-9']+")
+stopwords = frozenset("""
+a an and are as at be been but by do does did for from had has have he her hers him his i i'm im in is it its
+me my of on or our she so than that the their them they this to too was we were what when where which who
+will with you your yours about just really very
+""".split())
+
+def tokenize(text: str) -> list:
+    """Lowercase terms with stopwords removed and plurals folded ("dogs" -> "dog")."""
+    terms = []
+    for term in token_pattern.findall(text.lower()):
+        if term in stopwords:
+            continue
+        if len(term) > 3 and term.endswith('s') and not term.endswith('ss'):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
 def remove_prefixes(text, prefixes: list):
     """
     Remove specified prefixes from the beginning of the text or dictionary values.
@@ -91,21 +199,57 @@ def remove_prefixes(text, prefixes: list):
     else:
         return text
 
+def pid_alive(pid: int) -> bool:
+    """Return True if a process with this pid is running on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 def generate_new_user_id():
     # Generate a UUID, remove dashes, and prepend 'user_'
     uuid_str = str(uuid.uuid4()).replace('-', '')
     return f"user_{uuid_str[:32]}"
 
-def generate_final_prompt(user_id: str, user_name: str, memory: str, user_utterance: str, conversation: str, buddy_name: str, user_summary : str, doc_context: str = ""):
+def generate_final_prompt(user_id: str, user_name: str, memory: str, user_utterance: str, conversation: str, buddy_name: str, user_summary : str, doc_context: str = "", transcript: str = ""):
     prompt_template = load_text_file('utilities/prompts/final_prompt_template.txt')
 
-    if conversation: #conversation is non empty
+    # ------------------------------------------------------------------
+    # Give every context section a token budget. Sections are packed in
+    # priority order and whatever a section leaves unused carries over to
+    # the next one, so short memories make room for more documents, etc.
+    # ------------------------------------------------------------------
+    section_units = {
+        'recent_turns': (conversation.splitlines() if conversation else [], True),
+        'memory': (memory.splitlines() if memory else [], False),
+        'summary': ([user_summary] if user_summary else [], False),
+        'documents': (doc_context.split("\n\n") if doc_context else [], False),
+        'transcript': (transcript.splitlines() if transcript else [], True),
+    }
+    packed = {}
+    carry = 0
+    for section in prompt_budget['priority']:
+        units, from_end = section_units[section]
+        budget = prompt_budget['sections'][section] + carry
+        packed[section], used = pack_section(units, budget, from_end=from_end)
+        carry = budget - used
+
+    if packed['recent_turns']: #conversation is non empty
         truncated_conversation =  f"""The following is a conversation of you and {user_name}, for context:
-        {truncate_conversation(conversation = conversation, word_limit = 100)}
+        {packed['recent_turns']}
         """
     else:
         truncated_conversation = ""
 
+    if packed['transcript']:
+        truncated_conversation = f"""The following is a transcript of what {user_name} has been listening to:
+        {packed['transcript']}
+        """ + truncated_conversation
+
+    memory = packed['memory']
     if memory:
         memory = f"""The following is a memory about {user_name}. It contains experiences and opinions.
         {memory}
@@ -115,13 +259,13 @@ def generate_final_prompt(user_id: str, user_name: str, memory: str, user_uttera
     # Include uploaded document content if available
     # ------------------------------------------------------------------
     doc_section = ""
-    if doc_context:
+    if packed['documents']:
         doc_section = f"""The following content is extracted from documents uploaded by {user_name}:
-        {doc_context}
+        {packed['documents']}
         """
 
     # Combine memory, summary and document context
-    memory_and_summary = "\n".join(filter(None, [memory, user_summary, doc_section]))
+    memory_and_summary = "\n".join(filter(None, [memory, packed['summary'], doc_section]))
 
     prompt = prompt_template.format(
         user_name=user_name,
@@ -132,39 +276,6 @@ def generate_final_prompt(user_id: str, user_name: str, memory: str, user_uttera
     )
     return prompt
 
-# ----------------------------------------------------------------------
-# Utility: Retrieve aggregated text of uploaded documents for a user
-# ----------------------------------------------------------------------
-
-def get_uploaded_documents(user_id: str, max_chars: int = 5000) -> str:
-    """Return concatenated text of all .txt documents uploaded by a user.
-
-    Args:
-        user_id (str): The ID of the user.
-        max_chars (int, optional): Character limit for the returned string. Defaults to 5000.
-
-    Returns:
-        str: Aggregated document content truncated to *max_chars* characters, or an empty string if no docs are found.
-    """
-    docs_root = os.path.join(global_path, 'documents', user_id)
-    if not os.path.isdir(docs_root):
-        return ""
-
-    contents = []
-    for fname in os.listdir(docs_root):
-        if fname.lower().endswith('.txt'):
-            try:
-                with open(os.path.join(docs_root, fname), 'r', encoding='utf-8') as f:
-                    file_text = f.read().strip()
-                    contents.append(f"{fname}:\n{file_text}")
-            except Exception:
-                # Skip unreadable files
-                continue
-
-    aggregated = "\n\n".join(contents)
-    # Truncate to reasonable length
-    return aggregated[:max_chars]
-
 def transcribe_audio(file_path : str):
 
     audio_file= open(f"{global_path}/audio.mp3", "rb")
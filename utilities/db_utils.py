@@ -5,12 +5,18 @@ File: utilities/db_utils.py
 Description: Implements methods/ functions for database operations
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, LargeBinary, Index, and_, or_, select, insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
 from werkzeug.security import generate_password_hash, check_password_hash
+from fastapi import HTTPException
 from fastapi.responses import JSONResponse
 from utilities.core_utils import *
+from utilities.context_utils import context_cache
+from utilities.auth_utils import hash_password, verify_password, needs_rehash, issue_session_token
+from datetime import timedelta
+import asyncio
+import base64
 
 Base = declarative_base()
 config = load_config()
@@ -27,8 +33,9 @@ class User(Base):
     email = Column(String(100), nullable=False)
     password_hash = Column(String(1024), nullable=False)
 
+    # Blocking versions for scripts; request handlers hash through auth_utils' process pool
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, config['auth']['hash_method'], config['auth']['salt_length'])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -36,6 +43,8 @@ class User(Base):
 # Memory model
 class Memory(Base):
     __tablename__ = 'memory'
+    # Per-user lookups, and the incremental id > last_id scans of the retrieval index
+    __table_args__ = (Index('ix_memory_user_id_id', 'user_id', 'id'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(100), nullable=False)
     memory = Column(Text, nullable=False)
@@ -44,6 +53,8 @@ class Memory(Base):
 # Conversation model
 class Conversation(Base):
     __tablename__ = 'conversation'
+    # Serves both the per-user tail query and keyset pagination
+    __table_args__ = (Index('ix_conversation_user_id_timestamp', 'user_id', 'timestamp'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(100), nullable=False)
     role = Column(String(50), nullable=False)
@@ -57,160 +68,461 @@ class Summary(Base):
     user_id = Column(String(100), unique=True, nullable=False)
     summary = Column(Text, nullable=False)
 
-#Instantiate a database Session =========================================================
+# Memory compaction progress per user
+class MemoryCompaction(Base):
+    __tablename__ = 'memory_compaction'
+    user_id = Column(String(100), primary_key=True)
+    # Fragments stored after this point have not been merged yet
+    compacted_through = Column(DateTime, nullable=False)
+    compacted_at = Column(DateTime, default=datetime.utcnow)
+
+# Rolling summary progress per user
+class SummaryProgress(Base):
+    __tablename__ = 'summary_progress'
+    user_id = Column(String(100), primary_key=True)
+    # Conversation rows up to this id are already folded into the summary
+    summarized_through_id = Column(Integer, nullable=False, default=0)
+    summarized_at = Column(DateTime, default=datetime.utcnow)
+
+# Compressed block of archived conversation rows for one user
+class ConversationArchive(Base):
+    __tablename__ = 'conversation_archive'
+    # Locates the blocks covering a time range for export or restore
+    __table_args__ = (Index('ix_conversation_archive_user_id_first_timestamp', 'user_id', 'first_timestamp'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String(100), nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
 
-engine = create_engine(config['database_url'])
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+#Instantiate a database Session =========================================================
 
-def get_db():
-    db = SessionLocal()
-    try:
+def async_database_url(url: str) -> str:
+    """Map a configured database URL onto its asyncio driver (asyncpg for Postgres, aiosqlite for SQLite)."""
+    if url.startswith('postgresql://') or url.startswith('postgres://'):
+        return 'postgresql+asyncpg://' + url.split('://', 1)[1]
+    if url.startswith('sqlite://'):
+        return 'sqlite+aiosqlite://' + url.split('://', 1)[1]
+    return url
+
+db_pool = config['db_pool']
+
+engine = create_async_engine(
+    async_database_url(config['database_url']),
+    pool_size=db_pool['pool_size'],
+    max_overflow=db_pool['max_overflow'],
+    pool_timeout=db_pool['pool_timeout_seconds'],
+    pool_recycle=db_pool['pool_recycle_seconds'],
+    pool_pre_ping=db_pool['pool_pre_ping'],
+)
+# expire_on_commit=False keeps returned rows usable without another round trip
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+async def init_db():
+    """Create missing tables, and indexes added to existing tables since they were created."""
+    def create(connection):
+        Base.metadata.create_all(bind=connection)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+    async with engine.begin() as connection:
+        await connection.run_sync(create)
+
+async def close_db():
+    await engine.dispose()
+
+
+#Write-behind buffer for conversation turns =============================================
+
+class ConversationBuffer:
+    """Group-commits conversation turns from concurrent requests.
+
+    A user turn and its buddy reply are queued together and always land in the
+    same transaction. A background task flushes pending pairs every
+    flush_interval (or as soon as max_batch_turns are waiting) with one
+    multi-row INSERT and one commit. With wait_for_commit the caller waits for
+    the flush that carries its pair; otherwise it returns immediately. Either
+    way, read_conversation waits for a user's pending pairs before querying,
+    so the next turn always sees the previous one.
+    """
+
+    def __init__(self, buffer_config: dict):
+        self.flush_interval = buffer_config['flush_interval_seconds']
+        self.max_batch = buffer_config['max_batch_turns']
+        self.max_attempts = buffer_config['max_attempts']
+        self.wait_for_commit = buffer_config['wait_for_commit']
+        self.drain_timeout = buffer_config['drain_timeout_seconds']
+        self.pending = []
+        self.wake = None
+        self.stopping = None
+        self.task = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(user_id) whenever a turn is added."""
+        self.listeners.append(listener)
+
+    async def start(self):
+        self.wake = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.task = asyncio.create_task(self.flusher())
+
+    async def stop(self):
+        """Let the flusher drain everything pending, for up to drain_timeout_seconds, then stop it."""
+        if self.task is None:
+            while self.pending:
+                await self.flush()
+            return
+
+        self.stopping.set()
+        self.wake.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            # A batch interrupted mid-write goes back to pending, so it is reported below rather than lost silently
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+        if self.pending:
+            error = RuntimeError(f"Conversation buffer stopped with {len(self.pending)} turns unwritten")
+            print(colored(str(error), 'red'))
+            for entry in self.pending:
+                if not entry["future"].done():
+                    entry["future"].set_exception(error)
+            self.pending = []
+
+    async def add_turn(self, user_id: str, user_role: str, user_message: str, buddy_role: str, buddy_message: str):
+        timestamp = datetime.utcnow()
+        rows = [
+            {"user_id": user_id, "role": user_role, "message": user_message, "timestamp": timestamp},
+            # Keeps the reply ordered after the utterance even within one batch
+            {"user_id": user_id, "role": buddy_role, "message": buddy_message, "timestamp": timestamp + timedelta(microseconds=1)},
+        ]
+        entry = {"user_id": user_id, "rows": rows, "future": asyncio.get_running_loop().create_future(), "attempts": 0}
+        self.pending.append(entry)
+        # The cached tail sees the pair right away; a failed flush invalidates it again
+        context_cache.written(user_id, 'conversation', update=lambda records: trim_conversation_tail(
+            records + [Conversation(**row) for row in rows], config['conversation']['tail_turns'], config['conversation']['tail_words']
+        ))
+
+        for listener in self.listeners:
+            listener(user_id)
+
+        if self.task is None:
+            # Buffer not running (e.g. scripts): write through
+            await self.flush()
+        elif sum(len(item["rows"]) for item in self.pending) >= self.max_batch:
+            self.wake.set()
+
+        if self.wait_for_commit:
+            await asyncio.shield(entry["future"])
+
+    async def wait_for_user(self, user_id: str):
+        """Wait until every pending turn for user_id is committed."""
+        futures = [entry["future"] for entry in self.pending if entry["user_id"] == user_id]
+        if futures:
+            if self.wake is not None:
+                self.wake.set()
+            await asyncio.gather(*(asyncio.shield(future) for future in futures), return_exceptions=True)
+
+    async def flusher(self):
+        # Each pass writes everything pending, so once stop() sets stopping the loop exits drained
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            while self.pending:
+                await self.flush()
+
+    async def flush(self):
+        batch, size = [], 0
+        while self.pending and (not batch or size + len(self.pending[0]["rows"]) <= self.max_batch):
+            entry = self.pending.pop(0)
+            batch.append(entry)
+            size += len(entry["rows"])
+        if not batch:
+            return
+
+        try:
+            async with SessionLocal() as db:
+                await db.execute(insert(Conversation), [row for entry in batch for row in entry["rows"]])
+                await db.commit()
+        except asyncio.CancelledError:
+            self.pending[:0] = batch
+            raise
+        except Exception as e:
+            print(colored(f"Conversation flush of {size} rows failed: {e!r}", 'red'))
+            retry = []
+            for entry in batch:
+                entry["attempts"] += 1
+                if entry["attempts"] < self.max_attempts:
+                    retry.append(entry)
+                else:
+                    context_cache.written(entry["user_id"], 'conversation')
+                    if not entry["future"].done():
+                        entry["future"].set_exception(e)
+            self.pending[:0] = retry
+            if retry:
+                await asyncio.sleep(self.flush_interval)
+            return
+
+        for entry in batch:
+            if not entry["future"].done():
+                entry["future"].set_result(True)
+
+conversation_buffer = ConversationBuffer(config['conversation_buffer'])
 
 
 #CRUD Database functions ================================================================
 
 
 # Create a new user
-def create_user(user_id: str, name: str, password: str, email : str, db: Session):
+async def create_user(user_id: str, name: str, password: str, email : str, db: AsyncSession):
     # Check if the email already exists in the database
-    existing_user = db.query(User).filter(User.email == email).first()
+    existing_user = await get_user_by_email(email=email, db=db)
     if existing_user:
         return JSONResponse(status_code=400, content={"message": "Duplicate email_id"})
 
     # If email doesn't exist, create a new user
     db_user = User(user_id=user_id, name=name, email=email)
-    db_user.set_password(password)
+    db_user.password_hash = await hash_password(password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return JSONResponse(status_code=201, content={"user_id": user_id})
+    await db.commit()
+    await db.refresh(db_user)
+    return JSONResponse(status_code=201, content={"user_id": user_id, "session_token": issue_session_token(user_id)})
 
-def user_login(email: str, password: str, db: Session):
+async def user_login(email: str, password: str, db: AsyncSession):
     # Check if the email exists in the database
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_by_email(email=email, db=db)
     if not user:
         return JSONResponse(status_code=400, content={"message": "email_id not found"})
     
     # Check if the password is correct
-    if not user.check_password(password):  # Assuming the User model has a check_password method
+    if not await verify_password(user.password_hash, password):
         return JSONResponse(status_code=400, content={"message": "Incorrect passowrd"})
 
-    # If both email and password match, return the user_id
-    return {"user_id": user.user_id, "user_name": user.name}    
+    # Upgrade hashes made with older parameters while the plain password is at hand
+    if needs_rehash(user.password_hash):
+        user.password_hash = await hash_password(password)
+        await db.commit()
+
+    # If both email and password match, return the user_id and a session token for later calls
+    return {"user_id": user.user_id, "user_name": user.name, "session_token": issue_session_token(user.user_id)}
 
 
+# Read user by email
+async def get_user_by_email(email: str, db: AsyncSession):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
+
 # Read user by user_id
-def get_user_by_id(user_id: str, db: Session):
-    return db.query(User).filter(User.user_id == user_id).first()
+async def get_user_by_id(user_id: str, db: AsyncSession):
+    result = await db.execute(select(User).where(User.user_id == user_id))
+    return result.scalars().first()
 
 # Update user details
-def update_user(user_id: str, name: str = None, password: str = None, db: Session = None):
-    db_user = db.query(User).filter(User.user_id == user_id).first()
+async def update_user(user_id: str, name: str = None, password: str = None, db: AsyncSession = None):
+    db_user = await get_user_by_id(user_id=user_id, db=db)
     if db_user:
         if name:
             db_user.name = name
         if password:
-            db_user.set_password(password)
-        db.commit()
-        db.refresh(db_user)
+            db_user.password_hash = await hash_password(password)
+        await db.commit()
+        await db.refresh(db_user)
     return True
 
 # Delete user
-def delete_user(user_id: str, db: Session):
-    db_user = db.query(User).filter(User.user_id == user_id).first()
+async def delete_user(user_id: str, db: AsyncSession):
+    db_user = await get_user_by_id(user_id=user_id, db=db)
     if db_user:
-        db.delete(db_user)
-        db.commit()
+        await db.delete(db_user)
+        await db.commit()
+        context_cache.written(user_id)
     return True
 
 # Route to update memory
-def update_memory(user_id: str, memory: str, db: Session):
-    return store_memory(db=db, user_id=user_id, memory=memory)
+async def update_memory(user_id: str, memory: str, db: AsyncSession):
+    return await store_memory(db=db, user_id=user_id, memory=memory)
 
 # Route to get memory
-def read_memory(user_id: str, db: Session):
-    memory = get_memory(db=db, user_id=user_id)
+async def read_memory(user_id: str, db: AsyncSession):
+    memory = await get_memory(db=db, user_id=user_id)
     if memory is None:
         raise HTTPException(status_code=404, detail="Memory not found")
     return memory
 
 # Route to add a conversation message
-def add_conversation(user_id: str, role: str, message: str, db: Session):
-    return store_conversation(db=db, user_id=user_id, role=role, message=message)
+async def add_conversation(user_id: str, role: str, message: str, db: AsyncSession):
+    return await store_conversation(db=db, user_id=user_id, role=role, message=message)
+
+# Route to add a user utterance and the buddy's reply as one atomic pair
+async def add_conversation_turn(user_id: str, user_role: str, user_message: str, buddy_role: str, buddy_message: str):
+    await conversation_buffer.add_turn(user_id=user_id, user_role=user_role, user_message=user_message, buddy_role=buddy_role, buddy_message=buddy_message)
 
 # Route to get conversation
-def read_conversation(user_id: str, db: Session):
-    conversation_records = get_conversation(db=db, user_id=user_id)
+async def read_conversation(user_id: str, db: AsyncSession, max_turns: int = None, max_words: int = None):
+    async def load():
+        # Read-your-writes: this user's buffered turns must be committed first
+        await conversation_buffer.wait_for_user(user_id)
+
+        # Only the most recent turns are loaded, so the cost does not grow with history length
+        return await get_conversation_tail(
+            db=db,
+            user_id=user_id,
+            max_turns=max_turns or config['conversation']['tail_turns'],
+            max_words=max_words or config['conversation']['tail_words']
+        )
+
+    # The default-sized tail is kept in the context cache, which add_turn keeps current
+    if max_turns is None and max_words is None:
+        conversation_records = await context_cache.get_or_load(user_id, 'conversation', load)
+    else:
+        conversation_records = await load()
     
     # Check if there are any conversation records
     if not conversation_records:
         return ""
 
     # Concatenate the conversation into a single string
-    conversation_str = ""
-    for record in conversation_records:
-        conversation_str += f"{record.role}: {record.message}\n"
-    
-    return conversation_str.strip()  # Remove the trailing newline
+    return "\n".join(f"{record.role}: {record.message}" for record in conversation_records).strip()
+
+# Route to page through conversation history, newest first
+async def read_conversation_page(user_id: str, db: AsyncSession, cursor: str = None, limit: int = None):
+    # Clamp to 1..max_page_size; a zero or negative LIMIT errors on Postgres and means no limit on SQLite
+    limit = max(1, min(limit or config['conversation']['page_size'], config['conversation']['max_page_size']))
+    records = await get_conversation_page(db=db, user_id=user_id, before=decode_cursor(cursor) if cursor else None, limit=limit + 1)
+
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_cursor(records[-1].timestamp, records[-1].id)
+
+    messages = [
+        {"id": record.id, "role": record.role, "message": record.message, "timestamp": record.timestamp.isoformat()}
+        for record in records
+    ]
+    return {"messages": messages, "next_cursor": next_cursor}
+
+def encode_cursor(timestamp: datetime, record_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{record_id}".encode()).decode()
+
+def decode_cursor(cursor: str):
+    timestamp, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(timestamp), int(record_id)
 
 
 #CRUD Database helper functions =========================================================
 
 
 # Store or update memory for a user
-def store_memory(db: Session, user_id: str, memory: str):
+async def store_memory(db: AsyncSession, user_id: str, memory: str):
     db_memory = Memory(user_id=user_id, memory=memory)
     db.add(db_memory)
-    db.commit()
-    db.refresh(db_memory)
+    await db.commit()
+    await db.refresh(db_memory)
+    context_cache.written(user_id, 'memory_synced')
     return db_memory
 
 # Retrieve memory for a user
-def get_memory(db: Session, user_id: str):
-    memory_records = db.query(Memory).filter(Memory.user_id == user_id).all()
+async def get_memory(db: AsyncSession, user_id: str):
+    result = await db.execute(select(Memory.memory).where(Memory.user_id == user_id))
+    memory_records = result.scalars().all()
     if not memory_records:
         return ""
-    return " ".join(record.memory for record in memory_records)
+    return " ".join(memory_records)
 
 # Store a conversation message
-def store_conversation(db: Session, user_id: str, role: str, message: str):
+async def store_conversation(db: AsyncSession, user_id: str, role: str, message: str):
     db_conversation = Conversation(user_id=user_id, role=role, message=message)
     db.add(db_conversation)
-    db.commit()
-    db.refresh(db_conversation)
+    await db.commit()
+    await db.refresh(db_conversation)
+    context_cache.written(user_id, 'conversation', update=lambda records: trim_conversation_tail(
+        records + [db_conversation], config['conversation']['tail_turns'], config['conversation']['tail_words']
+    ))
     return db_conversation
 
 # Retrieve conversation for a user
-def get_conversation(db: Session, user_id: str):
-    return db.query(Conversation).filter(Conversation.user_id == user_id).order_by(Conversation.timestamp).all()
+async def get_conversation(db: AsyncSession, user_id: str):
+    result = await db.execute(
+        select(Conversation).where(Conversation.user_id == user_id).order_by(Conversation.timestamp, Conversation.id)
+    )
+    return result.scalars().all()
+
+# Retrieve the most recent turns for a user, oldest first
+async def get_conversation_tail(db: AsyncSession, user_id: str, max_turns: int, max_words: int = None):
+    result = await db.execute(
+        select(Conversation)
+        .where(Conversation.user_id == user_id)
+        .order_by(Conversation.timestamp.desc(), Conversation.id.desc())
+        .limit(max_turns)
+    )
+    records = list(result.scalars().all())
+    records.reverse()
+    return trim_conversation_tail(records, max_turns, max_words)
+
+# Keep the newest records (oldest first) within max_turns and the word budget, always at least one
+def trim_conversation_tail(records: list, max_turns: int, max_words: int = None):
+    records = records[-max_turns:]
+    if max_words is not None:
+        words = 0
+        for index in range(len(records) - 1, -1, -1):
+            words += len(records[index].message.split())
+            if words > max_words and index < len(records) - 1:
+                return records[index + 1:]
+    return records
+
+# Retrieve one page of conversation older than the (timestamp, id) keyset, newest first
+async def get_conversation_page(db: AsyncSession, user_id: str, before=None, limit: int = 50):
+    query = select(Conversation).where(Conversation.user_id == user_id)
+    if before is not None:
+        timestamp, record_id = before
+        query = query.where(or_(
+            Conversation.timestamp < timestamp,
+            and_(Conversation.timestamp == timestamp, Conversation.id < record_id)
+        ))
+    result = await db.execute(query.order_by(Conversation.timestamp.desc(), Conversation.id.desc()).limit(limit))
+    return result.scalars().all()
 
 # Add or update summary for a user
-def upsert_summary(user_id: str, summary: str, db: Session):
-    return store_summary(db=db, user_id=user_id, summary=summary)
+async def upsert_summary(user_id: str, summary: str, db: AsyncSession):
+    return await store_summary(db=db, user_id=user_id, summary=summary)
 
 # Get summary for a user
-def get_user_summary(user_id: str, db: Session):
-    summary = retrieve_summary(db=db, user_id=user_id)
+async def get_user_summary(user_id: str, db: AsyncSession):
+    summary = await context_cache.get_or_load(user_id, 'summary', lambda: retrieve_summary(db=db, user_id=user_id))
     if summary is None:
         return ""
     return summary
 
 # Store or update summary for a user
-def store_summary(db: Session, user_id: str, summary: str):
-    db_summary = db.query(Summary).filter(Summary.user_id == user_id).first()
+async def store_summary(db: AsyncSession, user_id: str, summary: str):
+    result = await db.execute(select(Summary).where(Summary.user_id == user_id))
+    db_summary = result.scalars().first()
     if db_summary:
         db_summary.summary = summary
     else:
         db_summary = Summary(user_id=user_id, summary=summary)
         db.add(db_summary)
-    db.commit()
-    db.refresh(db_summary)
+    await db.commit()
+    await db.refresh(db_summary)
+    context_cache.written(user_id, 'summary', update=lambda _: summary)
     return db_summary
 
 # Retrieve summary for a user
-def retrieve_summary(db: Session, user_id: str):
-    summary_record = db.query(Summary).filter(Summary.user_id == user_id).first()
-    return summary_record.summary if summary_record else None
\ No newline at end of file
+async def retrieve_summary(db: AsyncSession, user_id: str):
+    result = await db.execute(select(Summary.summary).where(Summary.user_id == user_id))
+    return result.scalars().first()
@@ -0,0 +1,138 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/dense_utils.py
+Description: Implements local dense retrieval over hashed n-gram vectors, plus rank fusion with lexical results
+"""
+
+import fcntl
+import zlib
+import numpy as np
+from utilities.core_utils import *
+
+config = load_config()
+dense_config = config['dense_retrieval']
+
+
+class HashedEmbedder:
+    """Maps text to a fixed-width, L2-normalised float32 vector without any model.
+
+    Features are words, word n-grams and character n-grams of each word, hashed
+    into dim buckets with a sign bit (so collisions cancel out instead of
+    piling up) and weighted by log(1 + count). Character n-grams let related
+    forms ("hike", "hiking", "hikes") and partial overlaps score as similar.
+    """
+
+    def __init__(self, dim: int, word_ngrams: int, char_ngrams: int):
+        self.dim = dim
+        self.word_ngrams = word_ngrams
+        self.char_ngrams = char_ngrams
+
+    def features(self, text: str) -> list:
+        words = tokenize(text)
+        features = list(words)
+        for n in range(2, self.word_ngrams + 1):
+            features.extend(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+        for word in words:
+            padded = f"<{word}>"
+            features.extend("#" + padded[i:i + self.char_ngrams] for i in range(len(padded) - self.char_ngrams + 1))
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        features = self.features(text)
+        if not features:
+            return vector
+        hashes = np.fromiter((zlib.crc32(feature.encode('utf-8')) for feature in features), dtype=np.uint32, count=len(features))
+        buckets = (hashes % self.dim).astype(np.int64)
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, buckets, signs)
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_many(self, texts: list) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            matrix[row] = self.embed(text)
+        return matrix
+
+
+embedder = HashedEmbedder(dense_config['dim'], dense_config['word_ngrams'], dense_config['char_ngrams'])
+
+def top_rows(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k scores, best first, via a partial sort."""
+    if len(scores) > top_k:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+def reciprocal_rank_fusion(ranked_lists: list, k: int) -> list:
+    """Fuse ranked lists of keys into one: score = sum of 1 / (k + rank). Keys missing from a list add nothing."""
+    scores = {}
+    for ranked in ranked_lists:
+        for rank, key in enumerate(ranked, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class DenseDocumentStore:
+    """Per-user float32 matrix of chunk vectors, one row per chunk, queried with a single mat-vec product.
+
+    <global_path>/<dense_dir>/<user_id>/store.npy is one structured array
+    whose rows hold a chunk's doc_id, chunk number and vector, so a row can
+    never be paired with another chunk's vector. Writers rebuild it under a
+    per-user file lock and swap it in with os.replace; readers memory-map it.
+    """
+
+    def __init__(self, store_config: dict):
+        self.enabled = store_config['enabled']
+        self.dense_dir = os.path.join(global_path, store_config['dense_dir'])
+        # document_id() is 16 hex characters
+        self.dtype = np.dtype([('doc_id', 'U16'), ('chunk', '<i4'), ('vector', '<f4', (embedder.dim,))])
+
+    def user_dir(self, user_id: str) -> str:
+        return os.path.join(self.dense_dir, user_id)
+
+    def load(self, user_id: str, mmap: bool) -> np.ndarray:
+        try:
+            return np.load(os.path.join(self.user_dir(user_id), 'store.npy'), mmap_mode='r' if mmap else None)
+        except FileNotFoundError:
+            return np.zeros(0, dtype=self.dtype)
+
+    def save(self, user_id: str, store: np.ndarray):
+        temp_path = os.path.join(self.user_dir(user_id), f"store.{os.getpid()}.tmp.npy")
+        np.save(temp_path, store)
+        os.replace(temp_path, os.path.join(self.user_dir(user_id), 'store.npy'))
+
+    def update(self, user_id: str, doc_id: str, chunks: list):
+        """Replace doc_id's rows with vectors for chunks (an empty list just removes them)."""
+        os.makedirs(self.user_dir(user_id), exist_ok=True)
+        with open(os.path.join(self.user_dir(user_id), '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            store = self.load(user_id, mmap=False)
+            added = np.zeros(len(chunks), dtype=self.dtype)
+            added['doc_id'] = [doc_id] * len(chunks)
+            added['chunk'] = [chunk['chunk'] for chunk in chunks]
+            added['vector'] = embedder.embed_many([chunk['text'] for chunk in chunks])
+            self.save(user_id, np.concatenate([store[store['doc_id'] != doc_id], added]))
+
+    def add_document(self, user_id: str, doc_id: str, chunks: list):
+        if self.enabled:
+            self.update(user_id, doc_id, chunks)
+
+    def remove_document(self, user_id: str, doc_id: str):
+        if self.enabled:
+            self.update(user_id, doc_id, [])
+
+    def search(self, user_id: str, query: str, top_k: int) -> list:
+        """Return up to top_k (cosine, doc_id, chunk_number), best first."""
+        store = self.load(user_id, mmap=True)
+        if not len(store):
+            return []
+        scores = store['vector'] @ embedder.embed(query)
+        return [(float(scores[row]), str(store['doc_id'][row]), int(store['chunk'][row])) for row in top_rows(scores, top_k) if scores[row] > 0]
+
+
+dense_store = DenseDocumentStore(dense_config)
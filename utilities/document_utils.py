@@ -0,0 +1,588 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/document_utils.py
+Description: Implements document ingestion (text extraction, normalization, chunking) and the per-user chunk store
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import fcntl
+import hashlib
+import shutil
+import threading
+import unicodedata
+from utilities.core_utils import *
+from utilities.index_utils import document_index
+from utilities.dense_utils import dense_store, reciprocal_rank_fusion
+from utilities.context_utils import context_cache
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    # PDF uploads are rejected until pypdf is installed
+    PdfReader = None
+import aiofiles
+
+config = load_config()
+documents_config = config['documents']
+
+# Bump when extraction or normalization changes, so bulk ingestion reprocesses every file
+extractor_version = 1
+
+
+class DocumentError(Exception):
+    """Raised when an uploaded file cannot be turned into text."""
+
+class UploadTooLarge(DocumentError):
+    """Raised when an upload exceeds max_upload_bytes or the user's max_user_bytes quota."""
+
+
+# ----------------------------------------------------------------------
+# Extraction and normalization
+# ----------------------------------------------------------------------
+
+def extract_pages(path: str) -> list:
+    """Return the document's text as a list of (page_number, text); plain text is a single page."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in documents_config['extensions']:
+        raise DocumentError(f"Unsupported document type '{extension}'")
+
+    if extension == '.pdf':
+        if PdfReader is None:
+            raise DocumentError("PDF support requires the pypdf package")
+        try:
+            reader = PdfReader(path)
+            return [(number, page.extract_text() or "") for number, page in enumerate(reader.pages, start=1)]
+        except Exception as e:
+            raise DocumentError(f"Could not read PDF: {e}")
+
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return [(1, f.read())]
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalize, re-join hyphenated line breaks and collapse whitespace into single-newline paragraphs."""
+    text = unicodedata.normalize('NFKC', text).replace('\x00', '')
+    text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
+    paragraphs = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = " ".join(paragraph.split())
+        if paragraph:
+            paragraphs.append(paragraph)
+    return "\n".join(paragraphs)
+
+def chunk_pages(pages: list, chunk_words: int, overlap_words: int) -> list:
+    """Split pages into windows of chunk_words words that overlap by overlap_words.
+
+    Each chunk records the page it starts on, so answers can cite it.
+    """
+    words = []
+    for page_number, text in pages:
+        for line in normalize_text(text).split("\n"):
+            words.extend((word, page_number) for word in line.split())
+
+    chunks = []
+    step = max(1, chunk_words - overlap_words)
+    for start in range(0, len(words), step):
+        window = words[start:start + chunk_words]
+        chunks.append({"page": window[0][1], "text": " ".join(word for word, _ in window)})
+        if start + chunk_words >= len(words):
+            break
+    return chunks
+
+
+# ----------------------------------------------------------------------
+# Chunk store: <global_path>/<chunks_dir>/<user_id>/ holds one
+# <doc_id>.jsonl per document plus manifest.json describing them.
+# ----------------------------------------------------------------------
+
+def user_chunks_dir(user_id: str) -> str:
+    return os.path.join(global_path, documents_config['chunks_dir'], user_id)
+
+def store_lock(user_id: str):
+    """Hold while reading and rewriting a user's manifest; flock covers other workers and the bulk CLI too."""
+    os.makedirs(user_chunks_dir(user_id), exist_ok=True)
+    lock_file = open(os.path.join(user_chunks_dir(user_id), '.lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def document_id(filename: str) -> str:
+    # Re-uploading a file with the same name replaces its chunks
+    return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+
+def read_manifest(user_id: str) -> dict:
+    try:
+        with open(os.path.join(user_chunks_dir(user_id), 'manifest.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_json_atomic(path: str, data, lines: bool = False):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        if lines:
+            for item in data:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, path)
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(documents_config['upload_chunk_bytes']), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_settings() -> str:
+    """Fingerprint of everything that shapes a document's chunks; stored chunks with another one are stale."""
+    return f"{extractor_version}:{documents_config['chunk_words']}:{documents_config['overlap_words']}"
+
+def extract_document(path: str, filename: str = None, sha256: str = None) -> tuple:
+    """Extract, normalize and chunk one file without touching the store. Returns (manifest entry, chunk records).
+
+    sha256 may be passed when the caller already hashed the file while receiving it.
+    """
+    filename = os.path.basename(filename or path)
+    pages = extract_pages(path)
+    chunks = chunk_pages(pages, documents_config['chunk_words'], documents_config['overlap_words'])
+
+    doc_id = document_id(filename)
+    records = [
+        {"doc_id": doc_id, "chunk": index, "filename": filename, "page": chunk["page"], "text": chunk["text"]}
+        for index, chunk in enumerate(chunks)
+    ]
+    stat = os.stat(path)
+    entry = {
+        "doc_id": doc_id,
+        "filename": filename,
+        "sha256": sha256 or file_sha256(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "settings": chunk_settings(),
+        "pages": len(pages),
+        "chunks": len(records),
+        "ingested_at": time.time()
+    }
+    return entry, records
+
+def store_document(user_id: str, entry: dict, records: list) -> dict:
+    """Write a document's chunks and manifest entry, then index them. Returns the entry."""
+    doc_id = entry['doc_id']
+    chunks_dir = user_chunks_dir(user_id)
+    os.makedirs(chunks_dir, exist_ok=True)
+    with store_lock(user_id):
+        write_json_atomic(os.path.join(chunks_dir, f"{doc_id}.jsonl"), records, lines=True)
+        manifest = read_manifest(user_id)
+        manifest[doc_id] = entry
+        write_json_atomic(os.path.join(chunks_dir, 'manifest.json'), manifest)
+    document_index.add_document(user_id, doc_id, records)
+    dense_store.add_document(user_id, doc_id, records)
+    return entry
+
+def update_manifest_entry(user_id: str, doc_id: str, **fields):
+    with store_lock(user_id):
+        manifest = read_manifest(user_id)
+        if doc_id in manifest:
+            manifest[doc_id].update(fields)
+            write_json_atomic(os.path.join(user_chunks_dir(user_id), 'manifest.json'), manifest)
+
+def ingest_document(user_id: str, path: str, filename: str = None, sha256: str = None) -> dict:
+    """Extract, normalize and chunk one uploaded file into the user's chunk store. Returns its manifest entry."""
+    return store_document(user_id, *extract_document(path, filename, sha256))
+
+def delete_document(user_id: str, filename: str) -> bool:
+    """Remove a document's chunks from the store. Returns False if it was not there."""
+    doc_id = document_id(os.path.basename(filename))
+    chunks_dir = user_chunks_dir(user_id)
+    with store_lock(user_id):
+        manifest = read_manifest(user_id)
+        if manifest.pop(doc_id, None) is None:
+            return False
+        write_json_atomic(os.path.join(chunks_dir, 'manifest.json'), manifest)
+        try:
+            os.remove(os.path.join(chunks_dir, f"{doc_id}.jsonl"))
+        except FileNotFoundError:
+            pass
+    document_index.remove_document(user_id, doc_id)
+    dense_store.remove_document(user_id, doc_id)
+    return True
+
+def load_document_chunks(user_id: str, doc_id: str) -> list:
+    try:
+        with open(os.path.join(user_chunks_dir(user_id), f"{doc_id}.jsonl"), 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def load_chunks(user_id: str) -> list:
+    """Return every stored chunk for a user, in manifest order."""
+    chunks = []
+    for doc_id in read_manifest(user_id):
+        chunks.extend(load_document_chunks(user_id, doc_id))
+    return chunks
+
+def format_chunk(chunk: dict) -> str:
+    return f"{chunk['filename']} (p. {chunk['page']}):\n{chunk['text']}"
+
+def get_uploaded_documents(user_id: str, max_chars: int = None) -> str:
+    """Return the user's pre-extracted document chunks, separated by blank lines.
+
+    Only the chunk store is read; raw uploads are never parsed here.
+
+    Args:
+        user_id (str): The ID of the user.
+        max_chars (int, optional): Character limit for the returned string. Defaults to None, leaving
+            the size to the prompt's token budget.
+
+    Returns:
+        str: Aggregated chunks, truncated to *max_chars* characters if given, or an empty string if there are none.
+    """
+    aggregated = "\n\n".join(format_chunk(chunk) for chunk in load_chunks(user_id))
+    if max_chars is None:
+        return aggregated
+    return aggregated[:max_chars]
+
+def search_documents(user_id: str, query: str, top_k: int = None, require_match: bool = True) -> str:
+    """Return the chunks most relevant to query, best first and separated by blank lines.
+
+    With dense retrieval on, the BM25 and dense candidate lists are merged by
+    reciprocal rank fusion. With require_match, a dense candidate only counts
+    if its cosine reaches dense_retrieval.min_similarity or BM25 found it too,
+    since hashed n-gram vectors give small positive scores to unrelated text;
+    a query neither retriever really matches returns "".
+    """
+    top_k = top_k or document_index.top_k
+    if dense_store.enabled:
+        dense_config = config['dense_retrieval']
+        lexical = [(doc_id, number) for _, doc_id, number in document_index.search(user_id, query, top_k=dense_config['candidates'])] if document_index.enabled else []
+        dense = [
+            (doc_id, number) for score, doc_id, number in dense_store.search(user_id, query, top_k=dense_config['candidates'])
+            if not require_match or score >= dense_config['min_similarity'] or (doc_id, number) in lexical
+        ]
+        results = reciprocal_rank_fusion([lexical, dense], k=dense_config['rrf_k'])[:top_k]
+    else:
+        results = [(doc_id, number) for _, doc_id, number in document_index.search(user_id, query, top_k=top_k)]
+
+    documents = {doc_id: load_document_chunks(user_id, doc_id) for doc_id in {doc_id for doc_id, _ in results}}
+    chunks = []
+    for doc_id, number in results:
+        if number < len(documents[doc_id]):
+            chunks.append(format_chunk(documents[doc_id][number]))
+    return "\n\n".join(chunks)
+
+# ----------------------------------------------------------------------
+# Uploads: raw files are stored once per content at
+# <global_path>/<blobs_dir>/<sha256[:2]>/<sha256>, and each user's
+# <documents_dir>/<user_id>/<filename> is a hard link to its blob. A blob
+# is removed when its last link goes, which its link count tells us.
+# ----------------------------------------------------------------------
+
+def blobs_dir() -> str:
+    return os.path.join(global_path, documents_config['blobs_dir'])
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(blobs_dir(), sha256[:2], sha256)
+
+def user_documents_dir(user_id: str) -> str:
+    return os.path.join(global_path, documents_config['documents_dir'], user_id)
+
+class blob_lock:
+    """Serialises linking and releasing blobs across threads and worker processes."""
+
+    def __enter__(self):
+        os.makedirs(blobs_dir(), exist_ok=True)
+        self.lock_file = open(os.path.join(blobs_dir(), '.lock'), 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock_file.close()
+
+def safe_filename(filename: str) -> str:
+    """Reduce a client-supplied name to a bare file name with an accepted extension."""
+    filename = os.path.basename((filename or "").replace("\\", "/")).strip()
+    if filename in ("", ".", "..") or any(ord(char) < 32 for char in filename):
+        raise DocumentError("Invalid file name")
+    if os.path.splitext(filename)[1].lower() not in documents_config['extensions']:
+        raise DocumentError(f"Unsupported document type '{filename}'")
+    return filename
+
+def user_storage_bytes(user_id: str, exclude: str = None) -> int:
+    """Bytes the user's uploads take against their quota; a shared blob counts for every user linking it."""
+    try:
+        with os.scandir(user_documents_dir(user_id)) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file() and entry.name != exclude)
+    except FileNotFoundError:
+        return 0
+
+def linked_blob(path: str) -> str:
+    # A file with a single link is a standalone upload from before the blob store, not a blob reference
+    return file_sha256(path) if os.stat(path).st_nlink > 1 else None
+
+def release_blob(sha256: str):
+    # Only the blob's own name is left once st_nlink is 1; must be called under blob_lock
+    path = blob_path(sha256)
+    try:
+        if os.stat(path).st_nlink <= 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def link_upload(temp_path: str, sha256: str, target: str) -> bool:
+    """Move a received file into the blob store and point target at it. Returns False if target already had this content."""
+    blob = blob_path(sha256)
+    with blob_lock():
+        try:
+            if os.path.samefile(target, blob):
+                return False
+            previous = linked_blob(target)
+        except FileNotFoundError:
+            previous = None
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(temp_path, blob)
+        # Otherwise the content is already stored and the received copy is dropped by the caller
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_link = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(blob, temp_link)
+        except OSError:
+            # Filesystems without hard links get a private copy
+            shutil.copyfile(blob, temp_link)
+        os.replace(temp_link, target)
+        if previous not in (None, sha256):
+            release_blob(previous)
+    return True
+
+async def receive_upload(user_id: str, filename: str, upload) -> tuple:
+    """
+    Stream an upload to disk, store it by content and ingest it into the chunk store.
+
+    The body is read upload_chunk_bytes at a time and hashed as it is
+    written, so memory stays flat whatever the file size. Reading stops as
+    soon as the file passes max_upload_bytes or what is left of the user's
+    max_user_bytes quota. Identical content is stored once across all users,
+    and re-uploading a file the user already has skips ingestion.
+
+    Args:
+    user_id (str): The uploading user.
+    filename (str): The client-supplied file name.
+    upload: A FastAPI/Starlette UploadFile.
+
+    Returns:
+    tuple: (manifest entry, whether the document was unchanged)
+    """
+    filename = safe_filename(filename)
+    target = os.path.join(user_documents_dir(user_id), filename)
+    used = await asyncio.to_thread(user_storage_bytes, user_id, filename)
+    limit = min(documents_config['max_upload_bytes'], documents_config['max_user_bytes'] - used)
+
+    temp_dir = os.path.join(blobs_dir(), 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            while block := await upload.read(documents_config['upload_chunk_bytes']):
+                size += len(block)
+                if size > limit:
+                    if limit < documents_config['max_upload_bytes']:
+                        raise UploadTooLarge(f"Upload would exceed the storage quota of {documents_config['max_user_bytes']} bytes")
+                    raise UploadTooLarge(f"Upload exceeds the limit of {documents_config['max_upload_bytes']} bytes")
+                digest.update(block)
+                await f.write(block)
+        sha256 = digest.hexdigest()
+        changed = await asyncio.to_thread(link_upload, temp_path, sha256, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    entry = read_manifest(user_id).get(document_id(filename))
+    if not changed and entry is not None and entry.get('sha256') == sha256 and entry.get('settings') == chunk_settings():
+        return entry, True
+    try:
+        entry = await asyncio.to_thread(ingest_document, user_id, target, filename, sha256)
+    except DocumentError:
+        # Unreadable files are not kept, so they do not count against the quota
+        await asyncio.to_thread(remove_upload, user_id, filename)
+        raise
+    return entry, False
+
+def remove_upload(user_id: str, filename: str) -> bool:
+    """Remove the user's raw upload, and its blob if no one else links it. Returns False if it was not there."""
+    target = os.path.join(user_documents_dir(user_id), os.path.basename(filename))
+    with blob_lock():
+        try:
+            sha256 = linked_blob(target)
+        except FileNotFoundError:
+            return False
+        os.remove(target)
+        if sha256 is not None:
+            release_blob(sha256)
+    return True
+
+def reindex_documents(user_id: str) -> int:
+    """Rebuild a user's lexical and dense document indexes from the chunk store. Returns documents indexed."""
+    manifest = read_manifest(user_id)
+    for doc_id in manifest:
+        chunks = load_document_chunks(user_id, doc_id)
+        document_index.add_document(user_id, doc_id, chunks)
+        dense_store.add_document(user_id, doc_id, chunks)
+    return len(manifest)
+
+
+# ----------------------------------------------------------------------
+# Bulk (re)ingestion of the whole documents tree, e.g. after a change to
+# the chunking settings. Extraction and chunking run in a process pool;
+# the parent writes the chunk store and indexes.
+# ----------------------------------------------------------------------
+
+def prepare_document(path: str, filename: str, known_sha256: str = None) -> tuple:
+    """Pool worker: return (entry, records), or (entry, None) if the file still hashes to known_sha256."""
+    sha256 = file_sha256(path)
+    if sha256 == known_sha256:
+        return {"sha256": sha256}, None
+    try:
+        return extract_document(path, filename, sha256)
+    except DocumentError as e:
+        return {"error": str(e)}, None
+
+def pending_documents(user_ids: list, since: float = None):
+    """
+    Yield (user_id, path, filename, size, known_sha256) for every upload whose chunks are missing or stale.
+
+    A file is up to date when its manifest entry has the current chunk_settings()
+    and, with since, was ingested after it, or otherwise still has the same
+    size and mtime. Files whose size or mtime changed are passed with their old
+    hash, so a worker can skip re-chunking when the content is the same.
+    """
+    for user_id in user_ids:
+        user_root = user_documents_dir(user_id)
+        if not os.path.isdir(user_root):
+            continue
+        manifest = read_manifest(user_id)
+        for filename in sorted(os.listdir(user_root)):
+            path = os.path.join(user_root, filename)
+            if not os.path.isfile(path) or os.path.splitext(filename)[1].lower() not in documents_config['extensions']:
+                continue
+            stat = os.stat(path)
+            entry = manifest.get(document_id(filename))
+            known_sha256 = None
+            if entry is not None and entry.get('settings') == chunk_settings():
+                if since is not None:
+                    if entry['ingested_at'] >= since:
+                        continue
+                elif entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+                    continue
+                else:
+                    known_sha256 = entry['sha256']
+            yield user_id, path, filename, stat.st_size, known_sha256
+
+def bulk_ingest_documents(user_id: str = None, workers: int = None, force: bool = False) -> dict:
+    """
+    Bring the chunk store up to date with every upload under documents_dir, using a process pool.
+
+    Each finished file is written to the manifest straight away, so the
+    manifest doubles as the checkpoint: an interrupted run picks up where it
+    stopped. A forced run reprocesses everything; its start time is kept in
+    the ingest_checkpoint file until it completes, so resuming it skips the
+    files it already redid. Throughput is printed as the run goes.
+
+    Args:
+    user_id (str, optional): Only this user's uploads. Defaults to everyone.
+    workers (int, optional): Pool size. Defaults to documents.ingest_workers, or the CPU count when that is 0.
+    force (bool): Reprocess files even when their chunks are current.
+
+    Returns:
+    dict: Counts of ingested, unchanged and failed files, and bytes read.
+    """
+    workers = workers or documents_config['ingest_workers'] or os.cpu_count()
+    documents_root = os.path.join(global_path, documents_config['documents_dir'])
+    user_ids = [user_id] if user_id else sorted(os.listdir(documents_root)) if os.path.isdir(documents_root) else []
+
+    checkpoint_path = os.path.join(global_path, documents_config['ingest_checkpoint'])
+    since = None
+    if force:
+        try:
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                since = json.load(f)['started_at']
+            print(colored(f"Resuming the forced ingestion started at {datetime.fromtimestamp(since)}", 'cyan'))
+        except FileNotFoundError:
+            since = time.time()
+            os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+            write_json_atomic(checkpoint_path, {"started_at": since})
+
+    stats = {"ingested": 0, "unchanged": 0, "failed": 0, "bytes": 0}
+    touched_users = set()
+    started = time.perf_counter()
+    last_report = started
+
+    def report(final: bool = False):
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        files = stats['ingested'] + stats['unchanged'] + stats['failed']
+        megabytes = stats['bytes'] / 1e6
+        print(colored(
+            f"{files} files, {megabytes:.1f} MB in {elapsed:.1f}s: {files / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s "
+            f"({stats['ingested']} ingested, {stats['unchanged']} unchanged, {stats['failed']} failed)",
+            'green' if final else 'cyan'
+        ))
+
+    def finish(future, job):
+        user, path, filename, size, _ = job
+        stats['bytes'] += size
+        try:
+            entry, records = future.result()
+        except Exception as e:
+            entry, records = {"error": repr(e)}, None
+        if 'error' in entry:
+            stats['failed'] += 1
+            print(colored(f"Skipped {user}/{filename}: {entry['error']}", 'yellow'))
+        elif records is None:
+            # Same content under a new mtime; remember it so the next run skips the file without hashing
+            stat = os.stat(path)
+            update_manifest_entry(user, document_id(filename), size=stat.st_size, mtime=stat.st_mtime)
+            stats['unchanged'] += 1
+        else:
+            store_document(user, entry, records)
+            touched_users.add(user)
+            stats['ingested'] += 1
+
+    # At most two files per worker are in flight, so memory stays flat however big the tree is
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+        for job in pending_documents(user_ids, since):
+            while len(in_flight) >= 2 * workers:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(future, in_flight.pop(future))
+            in_flight[pool.submit(prepare_document, job[1], job[2], job[4])] = job
+            if time.perf_counter() - last_report >= 10:
+                report()
+                last_report = time.perf_counter()
+        for future in concurrent.futures.as_completed(list(in_flight)):
+            finish(future, in_flight.pop(future))
+
+    if force:
+        os.remove(checkpoint_path)
+    for user in touched_users:
+        context_cache.written(user, 'documents')
+    report(final=True)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest uploaded documents whose chunks are missing or stale, in parallel.")
+    parser.add_argument('--user-id', help="only this user's documents")
+    parser.add_argument('--workers', type=int, help="worker processes (default: documents.ingest_workers, or the CPU count)")
+    parser.add_argument('--force', action='store_true', help="reprocess every file, resuming an interrupted forced run")
+    parser.add_argument('--reindex', action='store_true', help="also rebuild the search index from the chunk store")
+    args = parser.parse_args()
+    bulk_ingest_documents(args.user_id, workers=args.workers, force=args.force)
+    if args.reindex:
+        chunks_root = os.path.join(global_path, documents_config['chunks_dir'])
+        user_ids = [args.user_id] if args.user_id else sorted(os.listdir(chunks_root)) if os.path.isdir(chunks_root) else []
+        print(f"Reindexed {sum(reindex_documents(user_id) for user_id in user_ids)} documents")
+    context_cache.close()
@@ -0,0 +1,133 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/export_utils.py
+Description: Implements a streaming NDJSON export of a user's summary, memories and conversations
+"""
+
+import argparse
+import asyncio
+import sys
+from datetime import timezone
+from utilities.db_utils import *
+from utilities.archive_utils import read_archived_conversation
+
+config = load_config()
+
+# Sections are exported in this order; a cursor names a section and the last id sent from it
+export_sections = ['summary', 'memory', 'conversation']
+
+def encode_export_cursor(section: str, record_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{section}|{record_id}".encode()).decode()
+
+def decode_export_cursor(cursor: str):
+    section, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    if section not in export_sections:
+        raise ValueError(f"Unknown export section {section!r}")
+    return section, int(record_id)
+
+def export_line(section: str, record: dict) -> str:
+    record = dict(record, type=section, cursor=encode_export_cursor(section, record['id']))
+    if isinstance(record.get('timestamp'), datetime):
+        record['timestamp'] = record['timestamp'].isoformat()
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+async def export_user_data(user_id: str, start: datetime = None, end: datetime = None, cursor: str = None):
+    """
+    Yield a user's data as NDJSON lines, using constant memory however long the history is.
+
+    Rows are read through server-side cursors, export.batch_rows at a time.
+    Every line carries a 'cursor'; passing the last one received resumes the
+    export right after it. Memories and conversation turns are limited to
+    timestamps in [start, end). Archived turns are sent before the hot ones;
+    archiving always takes the oldest rows, so ids keep increasing across both.
+    The export ends with a {"type": "end"} line holding the row counts.
+
+    Args:
+    user_id (str): The user to export.
+    start (datetime, optional): Earliest timestamp to include.
+    end (datetime, optional): Timestamp to stop before.
+    cursor (str, optional): Resume after the line that carried this cursor.
+    """
+    batch_rows = config['export']['batch_rows']
+    # Stored timestamps are naive UTC
+    start, end = [value.astimezone(timezone.utc).replace(tzinfo=None) if value and value.tzinfo else value for value in (start, end)]
+    resume_section, after_id = decode_export_cursor(cursor) if cursor else (export_sections[0], 0)
+
+    def after(section: str) -> int:
+        # Sections before the cursor's are already done; the cursor's own resumes after its id
+        position, resume_position = export_sections.index(section), export_sections.index(resume_section)
+        if position < resume_position:
+            return None
+        return after_id if position == resume_position else 0
+
+    def in_range(column):
+        clauses = []
+        if start is not None:
+            clauses.append(column >= start)
+        if end is not None:
+            clauses.append(column < end)
+        return clauses
+
+    # Include turns still waiting in the write-behind buffer
+    await conversation_buffer.wait_for_user(user_id)
+
+    counts = {section: 0 for section in export_sections}
+    async with SessionLocal() as db:
+        if after('summary') is not None:
+            result = await db.execute(select(Summary).where(Summary.user_id == user_id, Summary.id > after('summary')))
+            summary = result.scalars().first()
+            if summary is not None:
+                counts['summary'] += 1
+                yield export_line('summary', {"id": summary.id, "summary": summary.summary})
+
+        if after('memory') is not None:
+            result = await db.stream(
+                select(Memory.id, Memory.memory, Memory.timestamp)
+                .where(Memory.user_id == user_id, Memory.id > after('memory'), *in_range(Memory.timestamp))
+                .order_by(Memory.id)
+                .execution_options(yield_per=batch_rows)
+            )
+            async for row in result:
+                counts['memory'] += 1
+                yield export_line('memory', {"id": row.id, "memory": row.memory, "timestamp": row.timestamp})
+
+        if after('conversation') is not None:
+            async for row in read_archived_conversation(db, user_id, start=start, end=end, after_id=after('conversation')):
+                counts['conversation'] += 1
+                yield export_line('conversation', dict(row, archived=True))
+
+            result = await db.stream(
+                select(Conversation.id, Conversation.role, Conversation.message, Conversation.timestamp)
+                .where(Conversation.user_id == user_id, Conversation.id > after('conversation'), *in_range(Conversation.timestamp))
+                .order_by(Conversation.id)
+                .execution_options(yield_per=batch_rows)
+            )
+            async for row in result:
+                counts['conversation'] += 1
+                yield export_line('conversation', {"id": row.id, "role": row.role, "message": row.message, "timestamp": row.timestamp, "archived": False})
+
+    yield json.dumps({"type": "end", "user_id": user_id, "counts": counts}) + "\n"
+
+
+# Export one user to a file or stdout
+async def main():
+    parser = argparse.ArgumentParser(description="Export a user's summary, memories and conversations as NDJSON.")
+    parser.add_argument('user_id')
+    parser.add_argument('--start', type=datetime.fromisoformat, help="earliest timestamp to include (ISO 8601, UTC)")
+    parser.add_argument('--end', type=datetime.fromisoformat, help="timestamp to stop before (ISO 8601, UTC)")
+    parser.add_argument('--cursor', help="resume after the line carrying this cursor")
+    parser.add_argument('--output', help="file to append to (default: stdout)")
+    args = parser.parse_args()
+
+    output = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    try:
+        async for line in export_user_data(args.user_id, start=args.start, end=args.end, cursor=args.cursor):
+            output.write(line)
+    finally:
+        if args.output:
+            output.close()
+        await close_db()
+
+if __name__ == "__main__":
+    asyncio.run(main())
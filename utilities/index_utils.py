@@ -0,0 +1,319 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/index_utils.py
+Description: Implements a per-user, memory-mapped BM25 inverted index over document chunks
+"""
+
+import fcntl
+import hashlib
+import threading
+import uuid
+import numpy as np
+from collections import Counter, OrderedDict
+from utilities.core_utils import *
+
+config = load_config()
+
+SEGMENT_MAGIC = 0x314D53454D4D42  # "BMMSEM1"
+SEGMENT_VERSION = 1
+HEADER_FIELDS = 8
+
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# ----------------------------------------------------------------------
+# Segment file layout (little-endian, every array 8-byte aligned):
+#
+#   int64[8]             header: magic, version, terms, chunks, postings, total length, 0, 0
+#   uint64[terms]        sorted term hashes
+#   uint64[terms + 1]    postings offset of each term (prefix sums)
+#   uint32[chunks]       chunk -> index into the segment's document list
+#   uint32[chunks]       chunk -> chunk number within its document
+#   uint32[chunks]       chunk -> length in terms
+#   uint32[postings]     posting -> chunk
+#   uint32[postings]     posting -> term frequency
+#
+# Segments are immutable and named by a random id, so readers can mmap them
+# without locks; writers only add segments and swap the manifest.
+# ----------------------------------------------------------------------
+
+def write_segment(path: str, hashes, offsets, chunk_doc, chunk_number, chunk_length, posting_chunk, posting_tf):
+    header = np.array([
+        SEGMENT_MAGIC, SEGMENT_VERSION, len(hashes), len(chunk_doc), len(posting_chunk), int(np.sum(chunk_length, dtype=np.int64)), 0, 0
+    ], dtype='<i8')
+    arrays = [
+        header,
+        np.asarray(hashes, dtype='<u8'), np.asarray(offsets, dtype='<u8'),
+        np.asarray(chunk_doc, dtype='<u4'), np.asarray(chunk_number, dtype='<u4'), np.asarray(chunk_length, dtype='<u4'),
+        np.asarray(posting_chunk, dtype='<u4'), np.asarray(posting_tf, dtype='<u4'),
+    ]
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        for array in arrays:
+            f.write(array.tobytes())
+            # Pad each uint32 array so the next one stays aligned
+            if array.nbytes % 8:
+                f.write(b'\0' * (8 - array.nbytes % 8))
+    os.replace(temp_path, path)
+
+def build_segment_arrays(chunks: list):
+    """Arrays for write_segment from (doc_index, chunk_number, terms) tuples."""
+    postings = {}
+    chunk_doc, chunk_number, chunk_length = [], [], []
+    for chunk_index, (doc_index, number, terms) in enumerate(chunks):
+        chunk_doc.append(doc_index)
+        chunk_number.append(number)
+        chunk_length.append(len(terms))
+        for term, frequency in Counter(terms).items():
+            postings.setdefault(term_hash(term), []).append((chunk_index, frequency))
+
+    hashes = sorted(postings)
+    offsets, posting_chunk, posting_tf = [0], [], []
+    for hash_value in hashes:
+        for chunk_index, frequency in postings[hash_value]:
+            posting_chunk.append(chunk_index)
+            posting_tf.append(frequency)
+        offsets.append(len(posting_chunk))
+    return hashes, offsets, chunk_doc, chunk_number, chunk_length, posting_chunk, posting_tf
+
+
+class Segment:
+    """Read-only view of a segment file; pages are loaded by the OS on demand, not held by the worker."""
+
+    def __init__(self, path: str):
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        header = np.frombuffer(self.buffer, dtype='<i8', count=HEADER_FIELDS)
+        if header[0] != SEGMENT_MAGIC or header[1] != SEGMENT_VERSION:
+            raise ValueError(f"Not a segment file: {path}")
+        self.n_terms, self.n_chunks, self.n_postings, self.total_length = (int(value) for value in header[2:6])
+
+        position = header.nbytes
+        def take(dtype, count):
+            nonlocal position
+            array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=position)
+            position += -(-array.nbytes // 8) * 8
+            return array
+        self.hashes = take('<u8', self.n_terms)
+        self.offsets = take('<u8', self.n_terms + 1)
+        self.chunk_doc = take('<u4', self.n_chunks)
+        self.chunk_number = take('<u4', self.n_chunks)
+        self.chunk_length = take('<u4', self.n_chunks)
+        self.posting_chunk = take('<u4', self.n_postings)
+        self.posting_tf = take('<u4', self.n_postings)
+
+    def postings(self, hash_value: int):
+        """Return (chunks, term frequencies) for a term hash; empty arrays if absent."""
+        position = int(np.searchsorted(self.hashes, np.uint64(hash_value)))
+        if position >= self.n_terms or int(self.hashes[position]) != hash_value:
+            return self.posting_chunk[:0], self.posting_tf[:0]
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        return self.posting_chunk[start:end], self.posting_tf[start:end]
+
+
+class DocumentIndex:
+    """BM25 over each user's document chunks, kept as a small set of memory-mapped segments.
+
+    Adding a document writes one new segment; deleting one marks it deleted in
+    the manifest. Once a user has more than max_segments segments they are
+    merged into one, dropping deleted documents. The manifest is replaced
+    atomically, and writers on the host are serialized by a per-user file lock.
+    """
+
+    def __init__(self, index_config: dict):
+        self.enabled = index_config['enabled']
+        self.index_dir = os.path.join(global_path, index_config['index_dir'])
+        self.top_k = index_config['top_k']
+        self.k1 = index_config['bm25_k1']
+        self.b = index_config['bm25_b']
+        self.max_segments = index_config['max_segments']
+        self.max_open_segments = index_config['max_open_segments']
+        self.open_segments = OrderedDict()
+        self.segments_lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Storage
+    # ------------------------------------------------------------------
+
+    def user_dir(self, user_id: str) -> str:
+        return os.path.join(self.index_dir, user_id)
+
+    def segment_path(self, user_id: str, segment_id: str) -> str:
+        return os.path.join(self.user_dir(user_id), f"{segment_id}.seg")
+
+    def read_manifest(self, user_id: str) -> dict:
+        try:
+            with open(os.path.join(self.user_dir(user_id), 'manifest.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": {}}
+
+    def write_manifest(self, user_id: str, manifest: dict):
+        path = os.path.join(self.user_dir(user_id), 'manifest.json')
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, path)
+
+    def segment(self, user_id: str, segment_id: str) -> Segment:
+        path = self.segment_path(user_id, segment_id)
+        with self.segments_lock:
+            segment = self.open_segments.get(path)
+            if segment is None:
+                segment = Segment(path)
+                self.open_segments[path] = segment
+                while len(self.open_segments) > self.max_open_segments:
+                    self.open_segments.popitem(last=False)
+            self.open_segments.move_to_end(path)
+            return segment
+
+    def locked(self, user_id: str):
+        os.makedirs(self.user_dir(user_id), exist_ok=True)
+        lock_file = open(os.path.join(self.user_dir(user_id), '.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def add_document(self, user_id: str, doc_id: str, chunks: list):
+        """Index a document's chunks (dicts with 'chunk' and 'text'), replacing any previous version."""
+        if not self.enabled:
+            return
+        with self.locked(user_id):
+            manifest = self.read_manifest(user_id)
+            self.mark_deleted(manifest, doc_id)
+
+            segment_id = uuid.uuid4().hex
+            tokenized = [(0, chunk['chunk'], tokenize(chunk['text'])) for chunk in chunks]
+            write_segment(self.segment_path(user_id, segment_id), *build_segment_arrays(tokenized))
+            manifest["segments"][segment_id] = {
+                "docs": [{"doc_id": doc_id, "chunks": len(chunks), "length": sum(len(terms) for _, _, terms in tokenized)}],
+                "deleted": []
+            }
+            if len(manifest["segments"]) > self.max_segments:
+                self.merge(user_id, manifest)
+            self.commit(user_id, manifest)
+
+    def remove_document(self, user_id: str, doc_id: str):
+        if not self.enabled:
+            return
+        with self.locked(user_id):
+            manifest = self.read_manifest(user_id)
+            if self.mark_deleted(manifest, doc_id):
+                self.commit(user_id, manifest)
+
+    def mark_deleted(self, manifest: dict, doc_id: str) -> bool:
+        found = False
+        for info in manifest["segments"].values():
+            for doc_index, doc in enumerate(info["docs"]):
+                if doc["doc_id"] == doc_id and doc_index not in info["deleted"]:
+                    info["deleted"].append(doc_index)
+                    found = True
+        return found
+
+    def commit(self, user_id: str, manifest: dict):
+        """Drop fully deleted segments, write the manifest, then remove files it no longer names."""
+        for segment_id, info in list(manifest["segments"].items()):
+            if len(info["deleted"]) == len(info["docs"]):
+                del manifest["segments"][segment_id]
+        self.write_manifest(user_id, manifest)
+        for fname in os.listdir(self.user_dir(user_id)):
+            if fname.endswith('.seg') and fname[:-4] not in manifest["segments"]:
+                # Readers holding the old mapping keep working until they let go of it
+                os.remove(os.path.join(self.user_dir(user_id), fname))
+
+    def merge(self, user_id: str, manifest: dict):
+        """Rewrite every live segment into one, without going back to the chunk texts."""
+        docs, hashes, posting_chunk, posting_tf = [], [], [], []
+        chunk_doc, chunk_number, chunk_length = [], [], []
+        chunk_total = 0
+        for segment_id, info in manifest["segments"].items():
+            segment = self.segment(user_id, segment_id)
+            live_docs = [index for index in range(len(info["docs"])) if index not in info["deleted"]]
+            doc_map = np.full(len(info["docs"]), -1, dtype=np.int64)
+            doc_map[live_docs] = np.arange(len(docs), len(docs) + len(live_docs))
+            docs.extend(info["docs"][index] for index in live_docs)
+
+            live_chunks = doc_map[segment.chunk_doc] >= 0
+            chunk_map = np.full(segment.n_chunks, -1, dtype=np.int64)
+            chunk_map[live_chunks] = np.arange(chunk_total, chunk_total + int(live_chunks.sum()))
+            chunk_total += int(live_chunks.sum())
+            chunk_doc.append(doc_map[segment.chunk_doc][live_chunks])
+            chunk_number.append(segment.chunk_number[live_chunks])
+            chunk_length.append(segment.chunk_length[live_chunks])
+
+            term_of_posting = np.repeat(segment.hashes, np.diff(segment.offsets).astype(np.int64))
+            live_postings = chunk_map[segment.posting_chunk] >= 0
+            hashes.append(term_of_posting[live_postings])
+            posting_chunk.append(chunk_map[segment.posting_chunk][live_postings])
+            posting_tf.append(segment.posting_tf[live_postings])
+
+        hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+        posting_chunk = np.concatenate(posting_chunk) if posting_chunk else np.zeros(0, dtype=np.int64)
+        posting_tf = np.concatenate(posting_tf) if posting_tf else np.zeros(0, dtype=np.uint32)
+        order = np.lexsort((posting_chunk, hashes))
+        hashes, posting_chunk, posting_tf = hashes[order], posting_chunk[order], posting_tf[order]
+        unique_hashes, starts = np.unique(hashes, return_index=True)
+        offsets = np.append(starts, len(hashes))
+
+        segment_id = uuid.uuid4().hex
+        write_segment(
+            self.segment_path(user_id, segment_id), unique_hashes, offsets,
+            np.concatenate(chunk_doc) if chunk_doc else [], np.concatenate(chunk_number) if chunk_number else [],
+            np.concatenate(chunk_length) if chunk_length else [], posting_chunk, posting_tf
+        )
+        manifest["segments"] = {segment_id: {"docs": docs, "deleted": []}}
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def search(self, user_id: str, query: str, top_k: int = None) -> list:
+        """Return up to top_k (score, doc_id, chunk_number) for the query, best first."""
+        top_k = top_k or self.top_k
+        manifest = self.read_manifest(user_id)
+        try:
+            segments = [(self.segment(user_id, segment_id), info) for segment_id, info in manifest["segments"].items()]
+        except FileNotFoundError:
+            # A merge replaced a segment after we read the manifest
+            manifest = self.read_manifest(user_id)
+            segments = [(self.segment(user_id, segment_id), info) for segment_id, info in manifest["segments"].items()]
+
+        live_docs = [doc for _, info in segments for index, doc in enumerate(info["docs"]) if index not in info["deleted"]]
+        chunk_count = sum(doc["chunks"] for doc in live_docs)
+        if not chunk_count:
+            return []
+        average_length = sum(doc["length"] for doc in live_docs) / chunk_count or 1.0
+
+        query_hashes = [term_hash(term) for term in set(tokenize(query))]
+        term_postings = [[segment.postings(hash_value) for segment, _ in segments] for hash_value in query_hashes]
+
+        results = []
+        for position, (segment, info) in enumerate(segments):
+            scores = np.zeros(segment.n_chunks, dtype=np.float32)
+            for postings in term_postings:
+                chunks, frequencies = postings[position]
+                if not len(chunks):
+                    continue
+                df = sum(len(segment_postings[0]) for segment_postings in postings)
+                idf = np.log(1 + (chunk_count - df + 0.5) / (df + 0.5))
+                frequencies = frequencies.astype(np.float32)
+                lengths = segment.chunk_length[chunks].astype(np.float32)
+                scores[chunks] += idf * frequencies * (self.k1 + 1) / (frequencies + self.k1 * (1 - self.b + self.b * lengths / average_length))
+            if info["deleted"]:
+                scores[np.isin(segment.chunk_doc, info["deleted"])] = 0
+
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > top_k:
+                candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+            for chunk in candidates:
+                results.append((float(scores[chunk]), info["docs"][segment.chunk_doc[chunk]]["doc_id"], int(segment.chunk_number[chunk])))
+
+        results.sort(key=lambda result: result[0], reverse=True)
+        return results[:top_k]
+
+
+document_index = DocumentIndex(config['document_index'])
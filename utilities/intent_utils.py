@@ -0,0 +1,87 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/intent_utils.py
+Description: Implements a local rule-based intent classifier for prompt context selection
+"""
+
+import re
+from utilities.core_utils import *
+
+config = load_config()
+
+# ----------------------------------------------------------------------
+# Cue patterns, following the taxonomy in utilities/prompts/intent.txt.
+# Everything is compiled once at import; classifying an utterance is a
+# handful of regex searches and takes microseconds.
+# ----------------------------------------------------------------------
+
+# Mentions a meeting or earlier discussion, refers back to something said,
+# or asks for decisions and action items from a recent interaction.
+transcript_pattern = re.compile(r"""\b(?:
+    meeting|meetings|conversation|conversations|discussion|discussions|discussed|chat|call|
+    transcript|transcription|recording|recorded|lecture|class|podcast|
+    we\ (?:talked|spoke|discussed|were\ talking|just\ talked)|
+    you\ (?:mentioned|said|told\ me|suggested|brought\ up)|
+    (?:i|he|she|they)\ (?:mentioned|said|told\ you|brought\ up)|
+    earlier|before|last\ time|just\ now|a\ moment\ ago|again|
+    action\ items?|next\ steps|decisions?|decided|agreed|
+    as\ i\ (?:said|mentioned)|remember\ when|what\ did\ (?:i|we|you|he|she|they)
+)\b""", re.IGNORECASE | re.VERBOSE)
+
+# General knowledge, current information, device commands, personal questions
+# to the AI, scheduling and hypotheticals stand on their own.
+general_pattern = re.compile(r"""\b(?:
+    weather|temperature|forecast|what\ time|what\ day|today's\ date|what's\ the\ date|
+    who\ (?:is|was|invented|wrote|discovered)|what\ (?:is|are)\ (?:a|an|the)|define|definition\ of|how\ many|capital\ of|
+    set\ (?:a|an)\ (?:timer|alarm|reminder)|turn\ (?:on|off)|play\ (?:some|a|the)|volume|
+    how\ are\ you|your\ name|who\ are\ you|are\ you\ (?:real|a\ bot|an\ ai)|
+    schedule|book\ (?:a|an)|remind\ me\ to|tomorrow|next\ week|
+    what\ if|imagine|hypothetically|write\ (?:a|me\ a)|tell\ me\ a\ (?:joke|story)
+)\b""", re.IGNORECASE | re.VERBOSE)
+
+# Follow-ups lean on what came just before them.
+followup_pattern = re.compile(r"""^\s*(?:and|but|so|also|then|why|how\ come|what\ about|really|wait|ok|okay|yes|no|yeah|nope)\b
+    |\b(?:it|that|this|those|these|he|she|they|him|her|them|there)\b""", re.IGNORECASE | re.VERBOSE)
+
+# Refers to uploaded material. With a document index, such utterances get
+# the best-ranked chunks; others only get chunks that clear the relevance bar.
+documents_pattern = re.compile(r"""\b(?:
+    documents?|docs?|files?|pdfs?|uploads?|uploaded|attachments?|attached|
+    notes|report|reports|paper|papers|article|slides?|presentation|deck|
+    page\ \d+|section|chapter|according\ to|in\ the\ (?:text|doc|file|article|report|notes)
+)\b""", re.IGNORECASE | re.VERBOSE)
+
+
+def classify_intent(user_utterance: str) -> dict:
+    """
+    Decide which optional context an utterance needs.
+
+    Args:
+    user_utterance (str): The user's latest utterance.
+
+    Returns:
+    dict: {"requires_transcript": bool, "requires_documents": bool}. requires_transcript
+          covers both the stored conversation and any live transcription.
+    """
+    intent_config = config['intent']
+    if not intent_config['enabled']:
+        return {"requires_transcript": True, "requires_documents": True}
+
+    text = user_utterance.strip()
+    if transcript_pattern.search(text):
+        requires_transcript = True
+    elif len(text.split()) <= intent_config['followup_max_words']:
+        # Very short utterances ("why?", "haha really") only make sense in context
+        requires_transcript = True
+    elif followup_pattern.search(text):
+        # Checked before general cues, so "what about tomorrow?" keeps its context
+        requires_transcript = True
+    elif general_pattern.search(text):
+        requires_transcript = False
+    else:
+        requires_transcript = intent_config['default_requires_transcript']
+
+    requires_documents = bool(documents_pattern.search(text)) or intent_config['default_requires_documents']
+
+    return {"requires_transcript": requires_transcript, "requires_documents": requires_documents}
@@ -0,0 +1,142 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/limiter_utils.py
+Description: Implements per-provider concurrency and rate limits shared across worker processes
+"""
+
+import asyncio
+import random
+import sqlite3
+import threading
+import uuid
+from contextlib import asynccontextmanager
+from utilities.core_utils import *
+
+config = load_config()
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call could not get a provider slot before its deadline."""
+
+
+class LimiterStore:
+    """SQLite file holding concurrency leases and token buckets for every worker on the host.
+
+    Each acquire runs in one IMMEDIATE transaction, so the check and the update
+    are atomic across gunicorn workers.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases (lease_id TEXT PRIMARY KEY, provider TEXT NOT NULL, owner INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (provider TEXT NOT NULL, kind TEXT NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (provider, kind))"
+        )
+
+    def try_acquire(self, provider: str, limits: dict, tokens: int, lease_seconds: float):
+        """Take a concurrency slot plus one request and `tokens` tokens. Returns a lease id, or None if over a limit."""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Drop leases that expired or whose worker died without releasing them
+                for lease_id, owner, expires_at in self.connection.execute(
+                    "SELECT lease_id, owner, expires_at FROM leases WHERE provider = ?", (provider,)
+                ).fetchall():
+                    if expires_at < now or not pid_alive(owner):
+                        self.connection.execute("DELETE FROM leases WHERE lease_id = ?", (lease_id,))
+
+                active = self.connection.execute("SELECT COUNT(*) FROM leases WHERE provider = ?", (provider,)).fetchone()[0]
+                if active >= limits['max_concurrency']:
+                    self.connection.execute("ROLLBACK")
+                    return None
+
+                buckets = {}
+                for kind, cost in (('requests', 1), ('tokens', tokens)):
+                    capacity = limits[f'{kind}_per_minute']
+                    row = self.connection.execute(
+                        "SELECT tokens, updated_at FROM buckets WHERE provider = ? AND kind = ?", (provider, kind)
+                    ).fetchone()
+                    level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * capacity / 60)
+                    # A single call larger than the bucket may go once the bucket is full
+                    if level < min(cost, capacity):
+                        self.connection.execute("ROLLBACK")
+                        return None
+                    buckets[kind] = level - cost
+
+                for kind, level in buckets.items():
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO buckets (provider, kind, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                        (provider, kind, level, now)
+                    )
+                lease_id = uuid.uuid4().hex
+                self.connection.execute(
+                    "INSERT INTO leases (lease_id, provider, owner, expires_at) VALUES (?, ?, ?, ?)",
+                    (lease_id, provider, os.getpid(), now + lease_seconds)
+                )
+                self.connection.execute("COMMIT")
+                return lease_id
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def release(self, lease_id: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE lease_id = ?", (lease_id,))
+
+
+class ProviderLimiter:
+    """Queues provider calls until a concurrency slot and rate budget are free, or the deadline passes."""
+
+    def __init__(self, limiter_config: dict):
+        self.enabled = limiter_config['enabled']
+        self.providers = limiter_config['providers']
+        self.queue_timeout = limiter_config['queue_timeout_seconds']
+        self.lease_seconds = limiter_config['lease_seconds']
+        self.poll_interval = limiter_config['poll_interval_seconds']
+        self.store = LimiterStore(os.path.join(global_path, limiter_config['store_path']))
+
+    @asynccontextmanager
+    async def slot(self, provider: str, tokens: int = 0, timeout: float = None):
+        """Hold a slot for provider for the duration of the block."""
+        limits = self.providers.get(provider)
+        if not self.enabled or limits is None:
+            yield
+            return
+
+        deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+        delay = self.poll_interval
+        while True:
+            acquire = asyncio.ensure_future(asyncio.to_thread(self.store.try_acquire, provider, limits, tokens, self.lease_seconds))
+            try:
+                lease_id = await asyncio.shield(acquire)
+            except asyncio.CancelledError:
+                # The thread may still be granting a lease; give it back once it does
+                acquire.add_done_callback(self.release_abandoned)
+                raise
+            if lease_id is not None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RateLimitTimeout(f"No {provider} capacity within {self.queue_timeout}s")
+            # Jittered backoff so waiting workers don't poll in lockstep
+            await asyncio.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+            delay = min(delay * 2, 1.0)
+
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.store.release, lease_id)
+
+    def release_abandoned(self, future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self.store.release(future.result())
+
+
+limiter = ProviderLimiter(config['rate_limits'])
@@ -5,31 +5,68 @@ File: utilities/llm_utils.py
 Description: Implements llm calls
 """
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from pydantic import BaseModel
+import asyncio
 import boto3
+import httpx
 import json
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
-from groq import Groq
+from concurrent.futures import ThreadPoolExecutor
+from groq import AsyncGroq
 from utilities.core_utils import *
 load_dotenv()
 
-openai_client = OpenAI(api_key = os.getenv('OPENAI_KEY'))
-
 config = load_config()
 
-groq_client = Groq(
+# ----------------------------------------------------------------------
+# Shared, pooled clients. One httpx connection pool per worker process is
+# shared by the OpenAI and Groq SDKs so keep-alive connections are reused
+# across requests instead of being re-established for every LLM call.
+# ----------------------------------------------------------------------
+llm_http_config = config['llm_http']
+
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=llm_http_config['max_connections'],
+        max_keepalive_connections=llm_http_config['max_keepalive_connections'],
+        keepalive_expiry=llm_http_config['keepalive_expiry_seconds'],
+    ),
+    timeout=httpx.Timeout(llm_http_config['timeout_seconds'], connect=llm_http_config['connect_timeout_seconds']),
+)
+
+openai_client = AsyncOpenAI(api_key = os.getenv('OPENAI_KEY'), http_client=http_client)
+
+groq_client = AsyncGroq(
     api_key=os.getenv("GROQ_API_KEY"),
+    http_client=http_client,
 )
 
+# boto3 has no asyncio support, so Bedrock calls run on a dedicated thread
+# pool sized to match the client's connection pool. This keeps them off the
+# event loop without competing with the loop's default executor.
 bedrock_client = boto3.client(
     service_name='bedrock-runtime',
     aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
     aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
     region_name='us-east-1',
+    config=BotoConfig(max_pool_connections=llm_http_config['bedrock_max_workers']),
 )
 
+bedrock_executor = ThreadPoolExecutor(max_workers=llm_http_config['bedrock_max_workers'], thread_name_prefix='bedrock')
+
+async def run_off_loop(func, *args):
+    """Run a blocking callable on the Bedrock thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(bedrock_executor, func, *args)
+
+async def close_llm_clients():
+    """Release pooled connections. Called on application shutdown."""
+    await http_client.aclose()
+    bedrock_executor.shutdown(wait=False)
+
 class MemoryResponse(BaseModel):
     memory_found: bool
     memory: str
@@ -38,16 +75,17 @@ class GuardRailResponse(BaseModel):
     is_sensitive: bool
     explanation: str
 
-def openai_response(prompt_list : list, structured = False):
+async def openai_response(prompt_list : list, structured = False, max_tokens = None):
 
     global openai_client
 
     if structured == "True-memory":
 
-        completion = openai_client.beta.chat.completions.parse(
+        completion = await openai_client.beta.chat.completions.parse(
         model='gpt-4o-mini',
         messages=prompt_list,
         response_format=MemoryResponse,
+        max_tokens=max_tokens or fit_max_tokens('openai', prompt_list),
         )
         message = completion.choices[0].message
 
@@ -59,10 +97,11 @@ def openai_response(prompt_list : list, structured = False):
             return ({'memory_found' : False})
 
     else:
-        completion = openai_client.chat.completions.create(
+        completion = await openai_client.chat.completions.create(
             model = config['openai_model'],
             messages = prompt_list,
-            temperature = 0.2
+            temperature = 0.2,
+            max_tokens = max_tokens or fit_max_tokens('openai', prompt_list)
         )
     reply = completion.choices[0].message.content
     print("usage: ", completion.usage)
@@ -70,9 +109,9 @@ def openai_response(prompt_list : list, structured = False):
 
 #---
 
-def bedrock_response(prompt_list : list, structured = False):
+async def bedrock_response(prompt_list : list, structured = False, max_tokens = None):
     if structured == "True-memory":
-        message = claude_3_5_sonnet_response(prompt_list = prompt_list)
+        message = await claude_3_5_sonnet_response(prompt_list = prompt_list, max_tokens = max_tokens)
         # Attempt to parse the JSON response
         try:
             parsed_message = json.loads(message.content)
@@ -85,22 +124,22 @@ def bedrock_response(prompt_list : list, structured = False):
                     return {'memory_found': False}
             else:
                 # If the expected structure is not found, return memory_found as False
-                return {'memory_found': False}
+                return {'memory_found': False, 'fallback': True}
         
         except json.JSONDecodeError:
             # If JSON parsing fails, return memory_found as False
-            return {'memory_found': False}
+            return {'memory_found': False, 'fallback': True}
         except Exception:
             # Catch any other unexpected errors and return memory_found as False
-            return {'memory_found': False}
+            return {'memory_found': False, 'fallback': True}
 
     else:
-        reply = claude_3_5_sonnet_response(prompt_list = prompt_list)
+        reply = await claude_3_5_sonnet_response(prompt_list = prompt_list, max_tokens = max_tokens)
     return(reply)
 
-def groq_response(prompt_list : list, structured = False):
+async def groq_response(prompt_list : list, structured = False, max_tokens = None):
     if structured == "True-memory":
-        message = groq_mixtral_response(prompt_list)
+        message = await groq_mixtral_response(prompt_list, max_tokens = max_tokens)
         # Attempt to parse the JSON response
         try:
             parsed_message = json.loads(message.content)
@@ -113,43 +152,94 @@ def groq_response(prompt_list : list, structured = False):
                     return {'memory_found': False}
             else:
                 # If the expected structure is not found, return memory_found as False
-                return {'memory_found': False}
+                return {'memory_found': False, 'fallback': True}
         
         except json.JSONDecodeError:
             # If JSON parsing fails, return memory_found as False
-            return {'memory_found': False}
+            return {'memory_found': False, 'fallback': True}
         except Exception:
             # Catch any other unexpected errors and return memory_found as False
-            return {'memory_found': False}
+            return {'memory_found': False, 'fallback': True}
 
     else:
-        reply = groq_mixtral_response(prompt_list = prompt_list)
+        reply = await groq_mixtral_response(prompt_list = prompt_list, max_tokens = max_tokens)
     return(reply)
 
 # Initialize Bedrock client
-def claude_3_5_sonnet_response(prompt_list : list):
+async def claude_3_5_sonnet_response(prompt_list : list, max_tokens = None):
     messages = convert_openai_to_claude(prompt_list)
 
     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"  # Claude 3.5 Sonnet model
     body = json.dumps({
         "messages": messages,
-        "max_tokens": 200000,
+        "max_tokens": max_tokens or fit_max_tokens('bedrock', prompt_list),
         "temperature": 0.3,
         "top_p": 1,
         "top_k": 250,
         "anthropic_version": "bedrock-2023-05-31"
     })  
 
-    # Make the API call
-    response = bedrock_client.invoke_model(
-        modelId=model_id,
-        body=body
-    )
+    # Make the API call off the event loop
+    def invoke():
+        response = bedrock_client.invoke_model(
+            modelId=model_id,
+            body=body
+        )
+        return json.loads(response['body'].read())
 
     # Parse and print the response
-    response_body = json.loads(response['body'].read())
+    response_body = await run_off_loop(invoke)
     return(response_body['content'][0]['text'])
 
+async def claude_3_5_sonnet_stream(prompt_list : list, max_tokens = None):
+    """Yield text deltas from Bedrock's response stream as they arrive.
+
+    boto3's event stream is a blocking iterator, so it is drained on the
+    Bedrock thread pool and handed to the event loop through a queue.
+    """
+    messages = convert_openai_to_claude(prompt_list)
+
+    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+    body = json.dumps({
+        "messages": messages,
+        "max_tokens": max_tokens or fit_max_tokens('bedrock', prompt_list),
+        "temperature": 0.3,
+        "top_p": 1,
+        "top_k": 250,
+        "anthropic_version": "bedrock-2023-05-31"
+    })
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def pump():
+        try:
+            response = bedrock_client.invoke_model_with_response_stream(
+                modelId=model_id,
+                body=body
+            )
+            for event in response['body']:
+                chunk = json.loads(event['chunk']['bytes'])
+                if chunk.get('type') == 'content_block_delta':
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk['delta'].get('text', ''))
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+
+    pump_future = loop.run_in_executor(bedrock_executor, pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item:
+                yield item
+    finally:
+        await pump_future
+
 def convert_openai_to_claude(openai_messages):
     claude_messages = []
     system_content = ""
@@ -179,36 +269,61 @@ def convert_openai_to_claude(openai_messages):
 
     return claude_messages
 
-def groq_mixtral_response(prompt_list : list):
+async def groq_mixtral_response(prompt_list : list, max_tokens = None):
 
-    completion = groq_client.chat.completions.create(
+    completion = await groq_client.chat.completions.create(
         model="mixtral-8x7b-32768",
         messages= prompt_list,
         temperature=1,
-        max_tokens=32768,
+        max_tokens=max_tokens or fit_max_tokens('groq', prompt_list),
         top_p=1,
         stream=False,
         stop=None,
     )
     return(completion.choices[0].message.content)
 
-def openai_guardrail(prompt_list: list):
+async def openai_stream(prompt_list : list, max_tokens = None):
+    """Yield reply text deltas from OpenAI as they are generated."""
+    stream = await openai_client.chat.completions.create(
+        model = config['openai_model'],
+        messages = prompt_list,
+        temperature = 0.2,
+        max_tokens = max_tokens or fit_max_tokens('openai', prompt_list),
+        stream = True
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def groq_mixtral_stream(prompt_list : list, max_tokens = None):
+    """Yield reply text deltas from Groq as they are generated."""
+    stream = await groq_client.chat.completions.create(
+        model="mixtral-8x7b-32768",
+        messages= prompt_list,
+        temperature=1,
+        max_tokens=max_tokens or fit_max_tokens('groq', prompt_list),
+        top_p=1,
+        stream=True,
+        stop=None,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def openai_guardrail(prompt_list: list):
     global openai_client
 
-    try:
-        completion = openai_client.beta.chat.completions.parse(
-            model=config['openai_model'],
-            messages=prompt_list,
-            response_format=GuardRailResponse
-        )
-        message = completion.choices[0].message
+    # API errors propagate: GuardRail.check decides what a failed check means, and nothing gets cached
+    completion = await openai_client.beta.chat.completions.parse(
+        model=config['openai_model'],
+        messages=prompt_list,
+        response_format=GuardRailResponse
+    )
+    message = completion.choices[0].message
 
-        if message.refusal:
-            return {'is_sensitive': False}
-        elif message.parsed.is_sensitive == True:
-            return ({'is_sensitive' : True, 'explanation' : message.parsed.explanation})
-        else:
-            return ({'is_sensitive' : False})
-    except Exception as e:
-        print(f"Error in OpenAI API call: {str(e)}")
-        return {'is_sensitive' : False}
\ No newline at end of file
+    if message.refusal:
+        return {'is_sensitive': False}
+    elif message.parsed.is_sensitive == True:
+        return ({'is_sensitive' : True, 'explanation' : message.parsed.explanation})
+    else:
+        return ({'is_sensitive' : False})
\ No newline at end of file
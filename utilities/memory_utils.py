@@ -0,0 +1,175 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/memory_utils.py
+Description: Implements relevance-ranked memory retrieval with recency decay
+"""
+
+import asyncio
+import heapq
+import math
+from collections import Counter, OrderedDict
+from sqlalchemy import func
+from utilities.db_utils import *
+from utilities.context_utils import context_cache
+from utilities.dense_utils import embedder, dense_store
+import numpy as np
+
+config = load_config()
+
+
+class UserMemoryIndex:
+    """Term statistics and dense vectors for one user's memories, extended row by row as new memories arrive."""
+
+    def __init__(self):
+        self.last_id = 0
+        self.entries = {}
+        self.document_frequency = Counter()
+        self.total_length = 0
+        # Row i of vectors belongs to rows[i]; capacity doubles so appends stay amortised O(1)
+        self.rows = []
+        self.vectors = np.zeros((0, embedder.dim), dtype=np.float32)
+
+    def add(self, memory_id: int, memory: str, timestamp: datetime):
+        terms = Counter(tokenize(memory))
+        self.entries[memory_id] = (memory, timestamp, terms, sum(terms.values()))
+        self.document_frequency.update(terms.keys())
+        self.total_length += sum(terms.values())
+        self.last_id = max(self.last_id, memory_id)
+        if dense_store.enabled:
+            if len(self.rows) == len(self.vectors):
+                grown = np.zeros((max(16, 2 * len(self.vectors)), embedder.dim), dtype=np.float32)
+                grown[:len(self.rows)] = self.vectors
+                self.vectors = grown
+            self.vectors[len(self.rows)] = embedder.embed(memory)
+            self.rows.append(memory_id)
+
+
+class MemoryRetriever:
+    """Scores a user's memories against the current utterance and returns the best that fit a budget.
+
+    score = relevance + recency_weight * 0.5 ** (age / half_life), where relevance is BM25
+    (normalised to 0..1 over the candidates) blended with the dense cosine
+    similarity by dense_retrieval.memory_weight when dense retrieval is on.
+    With no overlap of either kind the ranking falls back to recency alone.
+    """
+
+    def __init__(self, retrieval_config: dict):
+        self.top_k = retrieval_config['top_k']
+        self.half_life_days = retrieval_config['recency_half_life_days']
+        self.recency_weight = retrieval_config['recency_weight']
+        self.k1 = retrieval_config['bm25_k1']
+        self.b = retrieval_config['bm25_b']
+        self.max_cached_users = retrieval_config['max_cached_users']
+        self.indexes = OrderedDict()
+        self.locks = {}
+
+    async def refresh(self, db: AsyncSession, user_id: str) -> UserMemoryIndex:
+        """Bring the cached index up to date, reading only rows it has not seen."""
+        lock = self.locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            index = self.indexes.get(user_id) or UserMemoryIndex()
+            # store_memory clears this flag, so an unchanged index needs no query at all
+            if user_id in self.indexes and context_cache.get(user_id, 'memory_synced') is True:
+                self.remember(user_id, index)
+                return index
+            generation = context_cache.generation(user_id, 'memory_synced')
+
+            count, max_id = (await db.execute(
+                select(func.count(Memory.id), func.max(Memory.id)).where(Memory.user_id == user_id)
+            )).one()
+            if count == len(index.entries) and (max_id or 0) == index.last_id:
+                self.remember(user_id, index)
+                context_cache.set(user_id, 'memory_synced', True, generation=generation)
+                return index
+
+            result = await db.execute(
+                select(Memory.id, Memory.memory, Memory.timestamp)
+                .where(Memory.user_id == user_id, Memory.id > index.last_id)
+                .order_by(Memory.id)
+            )
+            for memory_id, memory, timestamp in result.all():
+                index.add(memory_id, memory, timestamp)
+
+            if len(index.entries) != count:
+                # Rows were removed (e.g. by compaction): rebuild from scratch
+                index = UserMemoryIndex()
+                result = await db.execute(
+                    select(Memory.id, Memory.memory, Memory.timestamp).where(Memory.user_id == user_id).order_by(Memory.id)
+                )
+                for memory_id, memory, timestamp in result.all():
+                    index.add(memory_id, memory, timestamp)
+
+            self.remember(user_id, index)
+            context_cache.set(user_id, 'memory_synced', True, generation=generation)
+            return index
+
+    def remember(self, user_id: str, index: UserMemoryIndex):
+        self.indexes[user_id] = index
+        self.indexes.move_to_end(user_id)
+        while len(self.indexes) > self.max_cached_users:
+            evicted, _ = self.indexes.popitem(last=False)
+            self.locks.pop(evicted, None)
+
+    def rank(self, index: UserMemoryIndex, query: str) -> list:
+        """Return (score, memory_id) pairs for every memory, best first."""
+        if not index.entries:
+            return []
+        query_terms = set(tokenize(query))
+        count = len(index.entries)
+        average_length = index.total_length / count or 1
+        now = datetime.utcnow()
+
+        relevance = {}
+        for memory_id, (_, _, terms, length) in index.entries.items():
+            score = 0.0
+            for term in query_terms:
+                frequency = terms.get(term)
+                if not frequency:
+                    continue
+                df = index.document_frequency[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+            relevance[memory_id] = score
+        top_relevance = max(relevance.values()) or 1.0
+        relevance = {memory_id: score / top_relevance for memory_id, score in relevance.items()}
+
+        if dense_store.enabled and index.rows:
+            # One mat-vec product over the whole matrix; rows of deleted memories are skipped
+            similarities = index.vectors[:len(index.rows)] @ embedder.embed(query)
+            weight = config['dense_retrieval']['memory_weight']
+            for memory_id, similarity in zip(index.rows, similarities.tolist()):
+                if memory_id in relevance:
+                    relevance[memory_id] = (1 - weight) * relevance[memory_id] + weight * max(0.0, similarity)
+
+        scored = []
+        for memory_id, (_, timestamp, _, _) in index.entries.items():
+            age_days = max(0.0, (now - timestamp).total_seconds() / 86400) if timestamp else 0.0
+            recency = 0.5 ** (age_days / self.half_life_days)
+            scored.append((relevance[memory_id] + self.recency_weight * recency, memory_id))
+        return heapq.nlargest(len(scored), scored)
+
+    async def retrieve(self, db: AsyncSession, user_id: str, query: str, top_k: int = None, budget_tokens: int = None) -> list:
+        """Return up to top_k memories, best first, whose combined size fits budget_tokens."""
+        index = await self.refresh(db, user_id)
+        top_k = top_k or self.top_k
+        budget_tokens = budget_tokens or config['prompt_budget']['sections']['memory']
+
+        selected, used = [], 0
+        for _, memory_id in self.rank(index, query):
+            memory = index.entries[memory_id][0]
+            cost = count_tokens(memory) + 1
+            if used + cost > budget_tokens:
+                continue
+            selected.append(memory)
+            used += cost
+            if len(selected) >= top_k:
+                break
+        return selected
+
+
+memory_retriever = MemoryRetriever(config['memory_retrieval'])
+
+async def get_relevant_memory(db: AsyncSession, user_id: str, query: str) -> str:
+    """Memories most relevant to query, one per line, best first."""
+    return "\n".join(await memory_retriever.retrieve(db=db, user_id=user_id, query=query))
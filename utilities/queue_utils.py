@@ -0,0 +1,190 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/queue_utils.py
+Description: Implements a bounded background job queue backed by a durable local store
+"""
+
+import asyncio
+import sqlite3
+import threading
+from utilities.core_utils import *
+
+config = load_config()
+
+
+class JobStore:
+    """SQLite file that records every job until it succeeds, shared by all workers on the host."""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                last_error TEXT
+            )"""
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_available_at ON jobs (status, available_at)")
+
+    def add(self, name: str, payload: dict) -> int:
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (name, payload, status, owner, available_at) VALUES (?, ?, 'pending', ?, ?)",
+                (name, json.dumps(payload), os.getpid(), time.time())
+            )
+            return cursor.lastrowid
+
+    def get(self, job_id: int):
+        with self.lock:
+            return self.connection.execute("SELECT id, name, payload, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def complete(self, job_id: int):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id: int, available_at: float, error: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET attempts = attempts + 1, available_at = ?, last_error = ? WHERE id = ?",
+                (available_at, error, job_id)
+            )
+
+    def fail(self, job_id: int, error: str):
+        # Failed jobs are kept for inspection rather than retried forever
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (error, job_id)
+            )
+
+    def claim_due(self, limit: int) -> list:
+        """Take over due jobs owned by this process or by workers that are no longer running."""
+        pid = os.getpid()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id, owner FROM jobs WHERE status = 'pending' AND available_at <= ? ORDER BY id",
+                    (time.time(),)
+                ).fetchall()
+                claimed = [job_id for job_id, owner in rows if owner == pid or not pid_alive(owner)][:limit]
+                self.connection.executemany("UPDATE jobs SET owner = ? WHERE id = ?", [(pid, job_id) for job_id in claimed])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return claimed
+
+
+class JobQueue:
+    """Runs registered async handlers in the background with retries.
+
+    Jobs are written to the durable store before they are queued in memory, so
+    anything still pending when a worker exits (for example after gunicorn's
+    max_requests recycling) is picked up by the next worker's sweep.
+    """
+
+    def __init__(self, queue_config: dict):
+        self.store = JobStore(os.path.join(global_path, queue_config['store_path']))
+        self.max_pending = queue_config['max_pending']
+        self.worker_count = queue_config['workers']
+        self.max_attempts = queue_config['max_attempts']
+        self.retry_backoff = queue_config['retry_backoff_seconds']
+        self.sweep_interval = queue_config['sweep_interval_seconds']
+        self.drain_timeout = queue_config['drain_timeout_seconds']
+        self.handlers = {}
+        self.queue = None
+        self.enqueued = set()
+        self.tasks = []
+
+    def register(self, name: str, handler):
+        self.handlers[name] = handler
+
+    async def submit(self, name: str, payload: dict) -> int:
+        """Persist a job and queue it for this worker. Never waits for the job itself."""
+        job_id = await asyncio.to_thread(self.store.add, name, payload)
+        self.enqueue(job_id)
+        return job_id
+
+    def enqueue(self, job_id: int):
+        # When the in-memory queue is full the job simply waits in the store
+        # until a sweep finds room for it.
+        if self.queue is None or job_id in self.enqueued:
+            return
+        try:
+            self.queue.put_nowait(job_id)
+            self.enqueued.add(job_id)
+        except asyncio.QueueFull:
+            print(colored(f"Job queue full, job {job_id} deferred", 'yellow'))
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+        self.tasks.append(asyncio.create_task(self.sweeper()))
+
+    async def stop(self):
+        """Give queued jobs a chance to finish, then stop; leftovers stay in the store."""
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            print(colored(f"Job queue stopped with {self.queue.qsize()} jobs pending", 'yellow'))
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def sweep(self):
+        room = self.max_pending - self.queue.qsize()
+        if room <= 0:
+            return
+        for job_id in await asyncio.to_thread(self.store.claim_due, room):
+            self.enqueue(job_id)
+
+    async def sweeper(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(colored(f"Job sweep failed: {e!r}", 'red'))
+            await asyncio.sleep(self.sweep_interval)
+
+    async def worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            finally:
+                self.enqueued.discard(job_id)
+                self.queue.task_done()
+
+    async def run(self, job_id: int):
+        row = await asyncio.to_thread(self.store.get, job_id)
+        if row is None:
+            return
+        _, name, payload, attempts = row
+        try:
+            await self.handlers[name](**json.loads(payload))
+        except Exception as e:
+            error = repr(e)
+            if attempts + 1 >= self.max_attempts:
+                print(colored(f"Job {job_id} ({name}) failed permanently: {error}", 'red'))
+                await asyncio.to_thread(self.store.fail, job_id, error)
+            else:
+                delay = self.retry_backoff * 2 ** attempts
+                print(colored(f"Job {job_id} ({name}) failed, retrying in {delay}s: {error}", 'yellow'))
+                await asyncio.to_thread(self.store.retry, job_id, time.time() + delay, error)
+            return
+        await asyncio.to_thread(self.store.complete, job_id)
+
+
+job_queue = JobQueue(config['job_queue'])
@@ -0,0 +1,236 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/router_utils.py
+Description: Routes LLM calls across providers with failover and hedged requests
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import nullcontext
+from utilities.core_utils import *
+from utilities.limiter_utils import RateLimitTimeout
+
+config = load_config()
+
+
+class ProviderStats:
+    """Rolling latency and error window for one provider.
+
+    Streamed calls keep their time-to-first-token in a window of their own:
+    how long a reply runs says nothing about the provider, and only the
+    non-streamed latencies drive the latency policy and hedge delays.
+    """
+
+    def __init__(self, window_size: int):
+        self.latencies = deque(maxlen=window_size)
+        self.first_token_latencies = deque(maxlen=window_size)
+        self.outcomes = deque(maxlen=window_size)
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+
+    def record_stream_success(self, first_token_latency: float):
+        self.first_token_latencies.append(first_token_latency)
+        self.outcomes.append(True)
+
+    def record_failure(self):
+        self.outcomes.append(False)
+
+    def samples(self) -> int:
+        return len(self.outcomes)
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def percentile(self, percent: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def mean_latency(self):
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+
+class ProviderRouter:
+    """Picks a provider per call, fails over on errors and timeouts, and hedges slow calls.
+
+    Policies:
+        fixed   - the requested provider goes first; healthy fallbacks follow in configured order.
+        latency - all healthy providers are ordered by mean latency weighted by error rate.
+    Providers whose error rate exceeds max_error_rate are tried last under either policy.
+    """
+
+    def __init__(self, router_config: dict):
+        self.policy = router_config['policy']
+        self.providers = router_config['providers']
+        self.max_attempts = router_config['max_attempts']
+        self.timeout = router_config['timeout_seconds']
+        self.first_token_timeout = router_config['first_token_timeout_seconds']
+        self.min_samples = router_config['min_samples']
+        self.max_error_rate = router_config['max_error_rate']
+        self.hedge_config = router_config['hedge']
+        self.stats = {provider: ProviderStats(router_config['window_size']) for provider in self.providers}
+
+        # Hedge budget: every routed call earns budget_ratio of a hedge, each
+        # hedge spends one, capped at max_budget so bursts stay bounded.
+        self.hedge_budget = self.hedge_config['max_budget']
+
+    # ------------------------------------------------------------------
+    # Selection
+    # ------------------------------------------------------------------
+
+    def is_healthy(self, provider: str) -> bool:
+        stats = self.stats[provider]
+        return stats.samples() < self.min_samples or stats.error_rate() <= self.max_error_rate
+
+    def score(self, provider: str) -> float:
+        stats = self.stats[provider]
+        latency = stats.mean_latency()
+        if latency is None or stats.samples() < self.min_samples:
+            # Not enough data yet: rank it like an average provider
+            latency = self.hedge_config['default_delay_seconds']
+        return latency * (1 + stats.error_rate())
+
+    def order(self, preferred: str) -> list:
+        """Return providers in the order they should be attempted."""
+        if preferred not in self.providers:
+            preferred = self.providers[0]
+
+        if self.policy == 'latency':
+            ranked = sorted(self.providers, key=self.score)
+        else:
+            ranked = [preferred] + [provider for provider in self.providers if provider != preferred]
+
+        healthy = [provider for provider in ranked if self.is_healthy(provider)]
+        unhealthy = [provider for provider in ranked if not self.is_healthy(provider)]
+        return (healthy + unhealthy)[:self.max_attempts]
+
+    def hedge_delay(self, provider: str) -> float:
+        stats = self.stats[provider]
+        delay = None
+        if stats.samples() >= self.min_samples:
+            delay = stats.percentile(self.hedge_config['percentile'])
+        if delay is None:
+            delay = self.hedge_config['default_delay_seconds']
+        return max(delay, self.hedge_config['min_delay_seconds'])
+
+    def take_hedge_budget(self) -> bool:
+        if self.hedge_budget >= 1:
+            self.hedge_budget -= 1
+            return True
+        return False
+
+    # ------------------------------------------------------------------
+    # Execution
+    # ------------------------------------------------------------------
+
+    async def timed_call(self, provider: str, make_call, slot=None):
+        # Waiting for a local slot is not the provider's latency: the clock and timeout start once it is granted
+        async with slot(provider) if slot else nullcontext():
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(make_call(provider), timeout=self.timeout)
+            except (asyncio.CancelledError, RateLimitTimeout):
+                # A local limiter timeout says nothing about the provider's health
+                raise
+            except Exception:
+                self.stats[provider].record_failure()
+                raise
+            self.stats[provider].record_success(time.monotonic() - start)
+            return result
+
+    async def call(self, preferred: str, make_call, slot=None):
+        """Run make_call(provider) against the best provider, failing over and hedging as configured.
+
+        slot(provider), if given, returns an async context manager (e.g. a
+        limiter slot) entered before each attempt and kept out of its timing.
+        """
+        self.hedge_budget = min(self.hedge_config['max_budget'], self.hedge_budget + self.hedge_config['budget_ratio'])
+
+        candidates = self.order(preferred)
+        last_error = None
+        while candidates:
+            provider = candidates.pop(0)
+            try:
+                return await self.attempt(provider, candidates, make_call, slot)
+            except Exception as e:
+                print(colored(f"Provider {provider} failed: {e!r}", 'red'))
+                last_error = e
+        raise last_error
+
+    async def attempt(self, provider: str, backups: list, make_call, slot=None):
+        primary = asyncio.create_task(self.timed_call(provider, make_call, slot))
+        if not (self.hedge_config['enabled'] and backups):
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay(provider))
+        if done or not self.take_hedge_budget():
+            return await primary
+
+        # The primary has passed its latency deadline: race it against the
+        # next provider and keep whichever succeeds first.
+        backup = backups.pop(0)
+        print(colored(f"Hedging {provider} with {backup}", 'yellow'))
+        pending = {primary, asyncio.create_task(self.timed_call(backup, make_call, slot))}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, preferred: str, make_stream, slot=None):
+        """Yield from make_stream(provider), failing over if a provider errors before its first token.
+
+        slot(provider), if given, is held for the whole stream; the first-token
+        timeout and latency only start once it has been granted.
+        """
+        candidates = self.order(preferred)
+        last_error = None
+        for provider in candidates:
+            try:
+                async with slot(provider) if slot else nullcontext():
+                    stream = make_stream(provider)
+                    start = time.monotonic()
+                    try:
+                        first = await asyncio.wait_for(stream.__anext__(), timeout=self.first_token_timeout)
+                    except StopAsyncIteration:
+                        self.stats[provider].record_stream_success(time.monotonic() - start)
+                        return
+                    except Exception as e:
+                        if not isinstance(e, RateLimitTimeout):
+                            self.stats[provider].record_failure()
+                        print(colored(f"Provider {provider} failed: {e!r}", 'red'))
+                        last_error = e
+                        await stream.aclose()
+                        continue
+
+                    # Committed to this provider once the first token is out
+                    self.stats[provider].record_stream_success(time.monotonic() - start)
+                    yield first
+                    async for token in stream:
+                        yield token
+                    return
+            except RateLimitTimeout as e:
+                print(colored(f"Provider {provider} unavailable: {e!r}", 'red'))
+                last_error = e
+        raise last_error
+
+
+router = ProviderRouter(config['router'])
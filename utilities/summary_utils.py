@@ -0,0 +1,127 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/summary_utils.py
+Description: Implements rolling conversation summaries folded in the background
+"""
+
+import asyncio
+from utilities.db_utils import *
+from utilities.queue_utils import job_queue
+from utilities.utils import model_response
+
+config = load_config()
+
+
+class RollingSummarizer:
+    """Keeps each user's Summary row current without re-reading their history.
+
+    Every added turn is counted per user. After every_n_turns turns, or once a
+    user has been idle for idle_seconds with turns still unsummarized, a
+    'rolling_summary' job is queued. The job folds only the rows after
+    summary_progress.summarized_through_id into the existing summary, so each
+    fold costs the same however long the history is.
+    """
+
+    def __init__(self, summary_config: dict):
+        self.enabled = summary_config['enabled']
+        self.every_n_turns = summary_config['every_n_turns']
+        self.idle_seconds = summary_config['idle_seconds']
+        self.check_interval = summary_config['check_interval_seconds']
+        self.max_rows_per_fold = summary_config['max_rows_per_fold']
+        self.unsummarized = {}
+        self.last_turn_at = {}
+        self.task = None
+        # The event loop only keeps weak references to tasks; pending submits are held here until they finish
+        self.submits = set()
+
+    async def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.idle_checker())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.submits:
+            await asyncio.gather(*self.submits, return_exceptions=True)
+
+    def note_turn(self, user_id: str):
+        if not self.enabled:
+            return
+        self.unsummarized[user_id] = self.unsummarized.get(user_id, 0) + 1
+        self.last_turn_at[user_id] = time.monotonic()
+        if self.unsummarized[user_id] >= self.every_n_turns and self.task is not None:
+            self.schedule(user_id)
+
+    def schedule(self, user_id: str):
+        self.unsummarized.pop(user_id, None)
+        self.last_turn_at.pop(user_id, None)
+        task = asyncio.create_task(self.submit(user_id))
+        self.submits.add(task)
+        task.add_done_callback(self.submits.discard)
+
+    async def submit(self, user_id: str):
+        try:
+            await job_queue.submit('rolling_summary', {'user_id': user_id})
+        except Exception as e:
+            print(colored(f"Could not queue summary for {user_id}: {e!r}", 'red'))
+
+    async def idle_checker(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            for user_id, last_turn_at in list(self.last_turn_at.items()):
+                if now - last_turn_at >= self.idle_seconds:
+                    self.schedule(user_id)
+
+    async def fold(self, user_id: str):
+        """Fold every unsummarized turn of user_id into their summary, max_rows_per_fold rows per LLM call."""
+        # Buffered turns must be committed before they can be read back
+        await conversation_buffer.wait_for_user(user_id)
+        while True:
+            async with SessionLocal() as db:
+                folded = await self.fold_batch(db, user_id)
+            if folded < self.max_rows_per_fold:
+                return
+
+    async def fold_batch(self, db: AsyncSession, user_id: str) -> int:
+        progress = (await db.execute(select(SummaryProgress).where(SummaryProgress.user_id == user_id))).scalars().first()
+        through_id = progress.summarized_through_id if progress else 0
+
+        records = (await db.execute(
+            select(Conversation)
+            .where(Conversation.user_id == user_id, Conversation.id > through_id)
+            .order_by(Conversation.id)
+            .limit(self.max_rows_per_fold)
+        )).scalars().all()
+        if not records:
+            return 0
+
+        user = await get_user_by_id(user_id=user_id, db=db)
+        summary = await retrieve_summary(db=db, user_id=user_id)
+        prompt = load_text_file('utilities/prompts/rolling_summary_prompt.txt').format(
+            user_name=user.name if user else "the user",
+            summary=summary or "(no summary yet)",
+            conversation="\n".join(f"{record.role}: {record.message}" for record in records)
+        )
+        prompt_list = [
+            {"role": "system", "content": "You are an AI assistant tasked with generating a summary of a user's conversation."},
+            {"role": "user", "content": prompt}
+        ]
+        summary = await model_response(model_name=config['summary_model_name'], prompt_list=prompt_list)
+
+        # The new watermark commits together with the summary
+        if progress is None:
+            progress = SummaryProgress(user_id=user_id)
+            db.add(progress)
+        progress.summarized_through_id = records[-1].id
+        progress.summarized_at = datetime.utcnow()
+        await store_summary(db=db, user_id=user_id, summary=summary)
+        return len(records)
+
+
+rolling_summarizer = RollingSummarizer(config['rolling_summary'])
+conversation_buffer.add_listener(rolling_summarizer.note_turn)
+job_queue.register('rolling_summary', rolling_summarizer.fold)
@@ -0,0 +1,147 @@
+"""
+Author: Atif Quamar (atif7102@gmail.com)
+
+File: utilities/tts_utils.py
+Description: Implements text-to-speech with a shared client and a size-bounded disk cache of synthesized audio
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from google.cloud import texttospeech
+from utilities.core_utils import *
+
+config = load_config()
+tts_config = config['tts']
+
+
+class AudioCache:
+    """SQLite-file cache of synthesized audio shared by every worker on the host.
+
+    Entries are evicted least-recently-used first once their total size passes max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tts_cache (key TEXT PRIMARY KEY, audio BLOB NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ix_tts_cache_accessed_at ON tts_cache (accessed_at)")
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection.execute("SELECT audio FROM tts_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE tts_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tts_cache (key, audio, size, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, audio, len(audio), time.time())
+            )
+            # Keep the most recently used entries whose sizes add up to at most max_bytes
+            self.connection.execute(
+                "DELETE FROM tts_cache WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS running FROM tts_cache) WHERE running > ?)",
+                (self.max_bytes,)
+            )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM tts_cache").fetchone()[0]
+
+
+class SpeechSynthesizer:
+    """Synthesizes replies through one TextToSpeechClient per process.
+
+    The client, with its credentials and gRPC channel, is created on first use
+    and shared by every request; synthesis and cache lookups run on worker
+    threads so they never block the event loop. Replies of up to
+    max_cached_chars are cached by voice, encoding and text, so repeated ones
+    are served without a round-trip to Google.
+    """
+
+    def __init__(self, tts_config: dict):
+        self.voice_name = config['tts_voice_google']
+        self.credentials_path = tts_config['credentials_path']
+        self.max_cached_chars = tts_config['max_cached_chars']
+        self.cache = AudioCache(os.path.join(global_path, tts_config['cache_path']), tts_config['cache_max_bytes']) if tts_config['cache_enabled'] else None
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0}
+
+    def get_client(self):
+        with self.client_lock:
+            if self.client is None:
+                self.client = texttospeech.TextToSpeechClient.from_service_account_file(self.credentials_path)
+            return self.client
+
+    def audio_settings(self) -> tuple:
+        # Journey voices only return LINEAR16; everything else is sent as MP3
+        if 'Journey' in self.voice_name:
+            return texttospeech.AudioEncoding.LINEAR16, 'wav'
+        return texttospeech.AudioEncoding.MP3, 'mp3'
+
+    def cache_key(self, text: str, encoding) -> str:
+        canonical = json.dumps([self.voice_name, encoding.name, text], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def synthesize(self, text: str, encoding) -> bytes:
+        voice = texttospeech.VoiceSelectionParams(
+            language_code="en-US", ssml_gender=texttospeech.SsmlVoiceGender.FEMALE, name=self.voice_name
+        )
+        response = self.get_client().synthesize_speech(
+            input=texttospeech.SynthesisInput(text=text), voice=voice, audio_config=texttospeech.AudioConfig(audio_encoding=encoding)
+        )
+        return response.audio_content
+
+    async def speak(self, text: str) -> tuple:
+        """Return (audio bytes, file type) for text, from the cache when possible."""
+        encoding, audio_type = self.audio_settings()
+        cacheable = self.cache is not None and len(text) <= self.max_cached_chars
+        if cacheable:
+            key = self.cache_key(text, encoding)
+            audio = await asyncio.to_thread(self.cache.get, key)
+            if audio is not None:
+                self.counters['hits'] += 1
+                return audio, audio_type
+            self.counters['misses'] += 1
+
+        audio = await asyncio.to_thread(self.synthesize, text, encoding)
+        if cacheable:
+            await asyncio.to_thread(self.cache.set, key, audio)
+        return audio, audio_type
+
+    def close(self):
+        with self.client_lock:
+            if self.client is not None:
+                self.client.transport.close()
+                self.client = None
+
+    def stats(self) -> dict:
+        total = self.counters['hits'] + self.counters['misses']
+        return dict(
+            self.counters,
+            hit_rate=self.counters['hits'] / total if total else 0.0,
+            entries=len(self.cache) if self.cache is not None else 0
+        )
+
+
+speech_synthesizer = SpeechSynthesizer(tts_config)
+
+async def generate_text_to_speech(text: str) -> tuple:
+    """Return (audio bytes, file type: 'mp3' or 'wav') for text."""
+    return await speech_synthesizer.speak(text)
+
+def close_tts_client():
+    speech_synthesizer.close()
@@ -6,42 +6,169 @@ Description: Implements various global methods for Nova
 """
 
 from utilities.db_utils import *
-from utilities.llm_utils import openai_response, bedrock_response, groq_response
-from utilities.core_utils import remove_emojis, remove_prefixes, extract_quoted_content, get_uploaded_documents
+from utilities.llm_utils import openai_response, bedrock_response, groq_response, openai_stream, claude_3_5_sonnet_stream, groq_mixtral_stream, close_llm_clients
+from utilities.core_utils import remove_emojis, remove_prefixes, extract_quoted_content
+from utilities.document_utils import get_uploaded_documents, search_documents
+from utilities.index_utils import document_index
+from utilities.dense_utils import dense_store
+from utilities.router_utils import router
+from utilities.cache_utils import llm_cache
+from utilities.queue_utils import job_queue
+from utilities.limiter_utils import limiter
+from utilities.intent_utils import classify_intent
+from utilities.memory_utils import get_relevant_memory
+from utilities.context_utils import context_cache
+from utilities.tts_utils import generate_text_to_speech, speech_synthesizer, close_tts_client
+from guardrail_utils import guard
 import asyncio
 import concurrent.futures
-from google.cloud import texttospeech
 import io
 import zipfile
 import json
 
-async def generate_reply_1(user_utterance: str, user_name: str, conversation: str, user_id: str, db):
+reply_prefixes = ['Nova:', 'Nova :', 'Haha,', 'haha,', 'nova:', 'nova: ']
+
+async def constant(value):
+    return value
+
+async def load_reply_context(user_id: str, user_utterance: str, intent: dict, conversation: str = None):
+    """Fetch memory, summary, conversation and documents for a reply concurrently.
+
+    Each DB read runs on its own session, since one AsyncSession cannot run
+    queries in parallel. A conversation passed in by the caller is used as is.
+    """
+    async def read(func, **kwargs):
+        async with SessionLocal() as db:
+            return await func(db=db, **kwargs)
+
+    if conversation is None:
+        conversation_task = read(read_conversation, user_id=user_id) if intent['requires_transcript'] else constant("")
+    else:
+        conversation_task = constant(conversation)
+
+    return await asyncio.gather(
+        read(get_relevant_memory, user_id=user_id, query=user_utterance),
+        read(get_user_summary, user_id=user_id),
+        conversation_task,
+        load_documents(user_id, user_utterance, intent),
+    )
+
+def load_documents(user_id: str, user_utterance: str, intent: dict):
+    # With an index, an utterance that names its documents gets the best-ranked chunks; any other only
+    # gets chunks that really match it (usually none), so questions about a file's content still find it.
+    # Without one every chunk would go into the prompt, which only happens when the intent asks for documents.
+    if document_index.enabled or dense_store.enabled:
+        return asyncio.to_thread(search_documents, user_id, user_utterance, require_match=not intent['requires_documents'])
+    if not intent['requires_documents']:
+        return constant("")
+    return context_cache.get_or_load(user_id, 'documents', lambda: asyncio.to_thread(get_uploaded_documents, user_id))
+
+async def build_reply_prompt(user_utterance: str, user_name: str, user_id: str, conversation: str = None, transcript: str = "", intent: dict = None):
+    """Return the reply prompt list and the conversation it was built from."""
+    if intent is None:
+        intent = classify_intent(user_utterance)
+
     buddy_preamble = load_text_file('utilities/prompts/buddy_preamble.txt').format(buddy_name=buddy_name, user_name=user_name)
-    
-    memory = get_memory(db=db, user_id=user_id)
-    print(colored(f"Retrieved Memory: {memory}", 'red'))
 
-    # To retrieve a summary
-    user_summary = get_user_summary(user_id=user_id, db=db)
+    # Memory, summary, conversation tail and uploaded documents in one round
+    memory, user_summary, conversation, documents_context = await load_reply_context(user_id=user_id, user_utterance=user_utterance, intent=intent, conversation=conversation)
+    print(colored(f"Retrieved Memory: {memory}", 'red'))
 
-    # ------------------------------------------------------------------
-    # Fetch any uploaded document content for additional context
-    # ------------------------------------------------------------------
-    documents_context = get_uploaded_documents(user_id=user_id)
+    if not intent['requires_transcript']:
+        conversation, transcript = "", ""
 
-    content = generate_final_prompt(user_id=user_id, user_name=user_name, memory=memory, user_utterance=user_utterance, conversation=conversation, buddy_name=buddy_name, user_summary=user_summary, doc_context=documents_context)
+    content = generate_final_prompt(user_id=user_id, user_name=user_name, memory=memory, user_utterance=user_utterance, conversation=conversation, buddy_name=buddy_name, user_summary=user_summary, doc_context=documents_context, transcript=transcript)
     prompt_list = [{"role": "system", "content": buddy_preamble}, {"role": "user", "content": content}]
+    return prompt_list, conversation
 
-    # Run reply and memory synthesis concurrently using asyncio.gather
-    # This avoids the deadlock caused by running a new asyncio loop in a thread pool.
-    reply_task = model_response(model_name=reply_model_name, prompt_list=prompt_list)
-    memory_task = synthesize_memory(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation, db=db)
-    
-    # Wait for both tasks to complete. We primarily need the reply.
-    reply, _ = await asyncio.gather(reply_task, memory_task)
+async def generate_reply_1(user_utterance: str, user_name: str, user_id: str, conversation: str = None, transcript: str = "", intent: dict = None):
+    prompt_list, conversation = await build_reply_prompt(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation, transcript=transcript, intent=intent)
+
+    # Memory extraction never feeds into the reply, so it goes to the
+    # background job queue and the reply returns as soon as it is ready.
+    guard_task = start_guardrail(user_utterance)
+    if guard_task is not None and config['guardrail']['mode'] == 'serial':
+        if (await guard_task)['is_sensitive']:
+            return config['guardrail']['refusal_message']
+        guard_task = None
+
+    if guard_task is None:
+        await submit_memory_job(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation)
+    reply = await model_response(model_name=reply_model_name, prompt_list=prompt_list)
+
+    # Speculative mode: the guardrail ran alongside the reply and decides
+    # whether the finished reply is used and the utterance is remembered.
+    if guard_task is not None:
+        if (await guard_task)['is_sensitive']:
+            return config['guardrail']['refusal_message']
+        await submit_memory_job(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation)
 
     return reply
 
+async def generate_reply_stream(user_utterance: str, user_name: str, user_id: str, conversation: str = None, intent: dict = None):
+    """Streaming counterpart of generate_reply_1: yields reply text as it is generated.
+
+    Tokens that arrive before the guardrail has decided are held back, so a
+    sensitive utterance never leaks part of a reply.
+    """
+    prompt_list, conversation = await build_reply_prompt(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation, intent=intent)
+
+    guard_task = start_guardrail(user_utterance)
+    if guard_task is not None and config['guardrail']['mode'] == 'serial':
+        # As in generate_reply_1: a sensitive utterance queues no memory job and calls no model
+        if (await guard_task)['is_sensitive']:
+            yield config['guardrail']['refusal_message']
+            return
+        guard_task = None
+
+    # Sensitive utterances are never remembered, so in speculative mode the memory job waits for the verdict
+    async def remember():
+        await submit_memory_job(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation)
+
+    if guard_task is None:
+        await remember()
+    held = []
+    stream = model_stream(model_name=reply_model_name, prompt_list=prompt_list)
+    try:
+        async for token in stream:
+            if guard_task is None:
+                yield token
+                continue
+            held.append(token)
+            if guard_task.done():
+                if guard_task.result()['is_sensitive']:
+                    yield config['guardrail']['refusal_message']
+                    return
+                await remember()
+                yield "".join(held)
+                held, guard_task = [], None
+
+        if guard_task is not None:
+            if (await guard_task)['is_sensitive']:
+                yield config['guardrail']['refusal_message']
+                return
+            await remember()
+            if held:
+                yield "".join(held)
+    finally:
+        await stream.aclose()
+
+def start_guardrail(user_utterance: str):
+    """Start the guardrail check for an utterance in the background, or return None when it is off."""
+    if config['guardrail']['mode'] == 'off':
+        return None
+    return asyncio.create_task(guard.check(user_utterance))
+
+async def submit_memory_job(user_utterance: str, user_name: str, user_id: str, conversation: str):
+    await job_queue.submit('synthesize_memory', {'user_utterance': user_utterance, 'user_name': user_name, 'user_id': user_id, 'conversation': conversation})
+
+async def memory_job(user_utterance: str, user_name: str, user_id: str, conversation: str):
+    # Jobs outlive the request that queued them, so each one opens its own session
+    async with SessionLocal() as db:
+        await synthesize_memory(user_utterance=user_utterance, user_name=user_name, user_id=user_id, conversation=conversation, db=db)
+
+job_queue.register('synthesize_memory', memory_job)
+
 async def synthesize_memory(user_utterance: str, user_name: str, user_id: str, conversation, db):
     if user_utterance != "":
         user_utterance = f"""The utterance is given by the user. Remember that you have to extract the memory from the utterance only.
@@ -57,32 +184,42 @@ async def synthesize_memory(user_utterance: str, user_name: str, user_id: str, c
 
     prompt_list = [{"role": "system", "content": preamble}, {"role": "user", "content": final_prompt}]
 
-    response = await model_response(prompt_list=prompt_list, model_name=memory_model_name, structured='True-memory')
+    # Memory is extracted from the utterance only, so the cache key leaves out the conversation tail, which
+    # changes every turn; the user name stays in, since extracted memories are phrased with it
+    cache_key_prompt = [{"role": "system", "content": preamble}, {"role": "user", "content": f"{user_name}\n{user_utterance}"}]
+    response = await model_response(prompt_list=prompt_list, model_name=memory_model_name, structured='True-memory', cache_site='memory', cache_key_prompt=cache_key_prompt)
     
     if response['memory_found'] == True:
-        update_memory(db=db, user_id=user_id, memory=response['memory'])
+        await update_memory(db=db, user_id=user_id, memory=response['memory'])
         return True
     else:
         return False
 
-async def model_response(model_name: str, prompt_list: list, structured=False):
+async def model_response(model_name: str, prompt_list: list, structured=False, cache_site: str = None, cache_key_prompt: list = None):
     global config
 
-    if model_name == 'openai':
-        reply = openai_response(prompt_list, structured=structured)
-    elif model_name == 'bedrock':
-        reply = bedrock_response(prompt_list, structured=structured)
-    elif model_name == 'groq':
-        reply = groq_response(prompt_list, structured=structured)
-    else:
-        reply = openai_response(prompt_list, structured=structured)
+    # Provider calls are non-blocking, so the event loop keeps serving other
+    # requests (and the concurrent memory task) while this one is in flight.
+    # The router starts with model_name and fails over or hedges as configured.
+    # Call sites that pass a cache_site configured in llm_cache may skip the call entirely.
+    # Each provider attempt first waits for a slot from the cross-worker limiter;
+    # the router takes the slot itself so the wait is not counted as provider latency.
+    provider_functions = {'openai': openai_response, 'bedrock': bedrock_response, 'groq': groq_response}
+
+    def limiter_slot(provider):
+        return limiter.slot(provider, tokens=estimate_call_tokens(provider, prompt_list))
+
+    async def call(provider):
+        return await provider_functions[provider](prompt_list, structured=structured)
 
-    # If the reply is a coroutine, await it
-    if asyncio.iscoroutine(reply):
-        reply = await reply
+    reply = await llm_cache.get_or_call(
+        cache_site, model_name, prompt_list, structured,
+        lambda: router.call(model_name, call, slot=limiter_slot),
+        key_prompt=cache_key_prompt
+    )
 
     # Remove emojis and prefixes from the reply
-    reply = remove_prefixes(remove_emojis(reply), ['Nova:', 'Nova :', 'Haha,', 'haha,', 'nova:', 'nova: '])
+    reply = remove_prefixes(remove_emojis(reply), reply_prefixes)
     
     # New function to extract content within outermost quotes
     def extract_content(text):
@@ -92,7 +229,47 @@ async def model_response(model_name: str, prompt_list: list, structured=False):
 
     return reply
 
-async def generate_summary_and_insights(user_id: str, conversation: str, db: Session):
+async def model_stream(model_name: str, prompt_list: list):
+    """Yield cleaned reply tokens from the selected provider as they arrive."""
+    provider_streams = {'openai': openai_stream, 'bedrock': claude_3_5_sonnet_stream, 'groq': groq_mixtral_stream}
+
+    def limiter_slot(provider):
+        # The router holds the slot until the stream is fully consumed
+        return limiter.slot(provider, tokens=estimate_call_tokens(provider, prompt_list))
+
+    stream = router.stream(model_name, lambda provider: provider_streams[provider](prompt_list), slot=limiter_slot)
+
+    # Hold back the start of the reply until it can no longer be one of the
+    # prefixes model_response strips, then pass tokens straight through.
+    head = ""
+    head_limit = max(len(prefix) for prefix in reply_prefixes)
+    async for token in stream:
+        token = remove_emojis(token)
+        if head is None:
+            yield token
+            continue
+        head += token
+        stripped = head.lstrip()
+        if len(stripped) < head_limit and any(prefix.startswith(stripped) or stripped.startswith(prefix) for prefix in reply_prefixes):
+            continue
+        for prefix in reply_prefixes:
+            if stripped.startswith(prefix):
+                stripped = stripped[len(prefix):].lstrip()
+        head = None
+        if stripped:
+            yield stripped
+
+    if head:
+        yield remove_prefixes(head, reply_prefixes)
+
+def format_sse(data: dict, event: str = None) -> str:
+    """Encode a payload as a single Server-Sent Events message."""
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+async def generate_summary_and_insights(user_id: str, conversation: str, db: AsyncSession):
     # Load the summary prompt
     summary_prompt = load_text_file('utilities/prompts/summary_prompt.txt')
     print("limit 10")
@@ -103,39 +280,15 @@ async def generate_summary_and_insights(user_id: str, conversation: str, db: Ses
     ]
     
     # Generate the summary using one of the models
-    summary = await model_response(model_name=config['summary_model_name'], prompt_list=prompt_list, structured=False)
+    summary = await model_response(model_name=config['summary_model_name'], prompt_list=prompt_list, structured=False, cache_site='summary')
     
     # Add or update the summary in the database
-    upsert_summary(user_id=user_id, summary=summary, db=db)
+    await upsert_summary(user_id=user_id, summary=summary, db=db)
     
     return summary
 
-def generate_text_to_speech(text: str):
-    client = texttospeech.TextToSpeechClient.from_service_account_file('config/google_secret_key_tts.json')
-    voice_type = config['tts_voice_google']
-    voice = texttospeech.VoiceSelectionParams(
-        language_code="en-US", ssml_gender=texttospeech.SsmlVoiceGender.FEMALE, name=voice_type
-    )
-    type = 'mp3'
-    if 'Neural' in voice_type:
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
-        )
-        type = 'mp3'
-    elif 'Journey' in voice_type:
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.LINEAR16
-        )
-        type = 'wav'
-
-    input_text = texttospeech.SynthesisInput(text=text)
-    response = client.synthesize_speech(
-    input=input_text, voice=voice, audio_config=audio_config
-    )
-    return response, type
-
 def prepare_combined_content(reply, speech, audio_type):
-    audio_content = io.BytesIO(speech.audio_content)
+    audio_content = io.BytesIO(speech)
     audio_content.seek(0)
     # Create a JSON response with the text reply
     json_response = json.dumps({"text": reply}).encode('utf-8')
@@ -152,6 +305,6 @@ def create_zip_stream(reply: str, speech, audio_type: str):
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
         zip_file.writestr('reply.json', json.dumps({"text": reply}))
-        zip_file.writestr(f'audio.{audio_type}', speech.audio_content)
+        zip_file.writestr(f'audio.{audio_type}', speech)
     zip_buffer.seek(0)
     return zip_buffer
\ No newline at end of file